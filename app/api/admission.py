@@ -0,0 +1,140 @@
+# coding: utf-8
+"""Admission control for the stages of a request that wait on a shared resource.
+
+Each Stage admits at most `limit` requests at once (e.g. database reads,
+chat completions). Requests over the limit wait in a bounded queue ordered
+by priority (lower first) and arrival; when the queue is full a newcomer
+either takes the place of the lowest-priority waiter, which is rejected, or
+is rejected itself. A request that waits longer than `max_wait` is rejected
+too. Rejections raise Rejected with an HTTP status (429 queue full, 503
+waited too long) and a Retry-After estimate from the recent service time,
+so callers fail fast instead of piling up behind a saturated resource.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+
+class Rejected(Exception):
+
+    def __init__(self, stage, status, retry_after, reason):
+        super().__init__(f"{stage}: {reason}")
+        self.stage = stage
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Lease:
+    """An admitted request's slot in a stage; release() is idempotent."""
+
+    def __init__(self, stage, waited):
+        self.stage = stage
+        self.waited = waited
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.stage._release(time.monotonic() - self.started)
+
+
+class Stage:
+
+    def __init__(self, name, limit, max_queue=100, max_wait=5.0, alpha=0.1):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.alpha = alpha
+        self.active = 0
+        self.service_time = None  # EWMA seconds a lease is held
+        self._waiters = []        # heap of [priority, seq, future]
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.evicted = 0
+
+    def retry_after(self):
+        """Seconds until a new request would likely be admitted, at least 1."""
+        per_slot = self.service_time or 1.0
+        return max(1, math.ceil(per_slot * (len(self._waiters) + 1) / self.limit))
+
+    def _reject(self, status, reason):
+        return Rejected(self.name, status, self.retry_after(), reason)
+
+    def _discard(self, waiter):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+
+    async def acquire(self, priority=0):
+        """Wait for a slot; returns a Lease or raises Rejected."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return Lease(self, 0.0)
+
+        if len(self._waiters) >= self.max_queue:
+            worst = max(self._waiters)
+            if self.max_queue == 0 or worst[0] <= priority:
+                self.rejected += 1
+                raise self._reject(429, "queue full")
+            # A higher-priority request takes the place of the lowest-priority waiter
+            self._discard(worst)
+            self.evicted += 1
+            worst[2].set_exception(self._reject(429, "queue full"))
+
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        waiter = [priority, next(self._seq), future]
+        heapq.heappush(self._waiters, waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self._discard(waiter)
+            self.timeouts += 1
+            raise self._reject(503, f"waited more than {self.max_wait}s")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The slot was handed over just as the caller went away
+                self._release(None)
+            else:
+                self._discard(waiter)
+            raise
+        self.admitted += 1
+        return Lease(self, time.monotonic() - start)
+
+    def _release(self, held):
+        if held is not None:
+            self.service_time = (held if self.service_time is None
+                                 else (1 - self.alpha) * self.service_time + self.alpha * held)
+        # Hand the slot straight to the next waiter, so a newcomer can't take it first
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {"limit": self.limit, "active": self.active, "waiting": len(self._waiters),
+                "admitted": self.admitted, "queued": self.queued, "rejected": self.rejected,
+                "timeouts": self.timeouts, "evicted": self.evicted,
+                "service_ms": None if self.service_time is None else round(self.service_time * 1000, 1)}
+
+
+def parse_priorities(spec):
+    """{user_id: priority} from "alice=0,batch-jobs=5"."""
+    priorities = {}
+    for item in (spec or "").split(","):
+        if item.strip():
+            user, _, priority = item.partition("=")
+            priorities[user.strip()] = int(priority)
+    return priorities
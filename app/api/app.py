@@ -3,14 +3,29 @@
 from fastapi import FastAPI
 from fastapi import Header, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from pydantic import BaseModel, Field
 import os
-from openai import OpenAI
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from openai import AsyncOpenAI
 from glob import glob
-from sentence_transformers import SentenceTransformer
-from psycopg_pool import ConnectionPool
+from psycopg_pool import AsyncConnectionPool
 from psycopg.rows import namedtuple_row
 from fastapi.middleware.cors import CORSMiddleware
 import logging
+import time
+from cache import (embedding_cache_from_env, semantic_cache_from_env, api_key_cache_from_env,
+                   SingleFlight, normalize_question, LRUCache)
+from vectors import register_vector, fetch_vector_info, aprobe_binary, to_vector
+from embeddings import backend_from_env
+from local_index import local_index_from_env
+from compact import aload_projection
+from routing import ReadRouter
+from context import ContextBuilder, chat_encoding
+from metrics import ServerTimingMiddleware, record, record_usage, register_pools, render, timed
+from admission import Rejected, Stage, parse_priorities
 
 # Set up basic logging
 logging.basicConfig(
@@ -20,14 +35,241 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 bearer_scheme = HTTPBearer()
 
-# model = SentenceTransformer("all-MiniLM-L6-v2")
-
-client = OpenAI(
+# Async client so a single uvicorn worker can keep many requests in flight
+# while they wait on OpenAI, instead of parking one threadpool slot each.
+client = AsyncOpenAI(
     api_key=os.environ.get("OPENAI_API_KEY"),  # This is the default and can be omitted
 )
 
+# Question embeddings come from OpenAI by default; EMBEDDING_BACKEND=local runs
+# a SentenceTransformer/ONNX model on CPU instead (see embeddings.py). The
+# embeddings table must have been loaded with the same backend. Questions
+# embedded within EMBED_BATCH_WAIT_MS of each other share one call.
+embedder = backend_from_env(async_client=client)
+NO_CONTEXT_ANSWER = "I couldn't find relevant information in the database."
+
+# Docs version searched when a request doesn't name one
+DEFAULT_VERSION = os.environ.get("DEFAULT_VERSION", "v25.2")
+
+# /rag/batch: questions per request (one embeddings call, so at most the
+# API's 2048 inputs), chunks retrieved per question (k) and completions run
+# at once per request.
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS", "256"))
+BATCH_MAX_K = int(os.environ.get("BATCH_MAX_K", "20"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "8"))
+
+# Question embeddings, keyed by normalized question text and model name.
+# EMBED_CACHE_PATH enables a SQLite tier shared by all workers on the host.
+embedding_cache = embedding_cache_from_env()
+
+# Answers of past questions, reused for near-paraphrases of the same version.
+# Entries are invalidated when the embeddings rows they were built from change.
+answer_cache = semantic_cache_from_env()
+
+# Concurrent /rag requests for the same (normalized question, version, k)
+# share one retrieval + completion.
+rag_inflight = SingleFlight()
+
+# Optional in-process copy of the embeddings table (LOCAL_INDEX_PATH), searched
+# instead of the ORDER BY <-> query while it is current with the table.
+local_index = local_index_from_env()
+
+# Versions loaded with --compact-dimensions are searched on the reduced
+# embedding_compact column, and the best COMPACT_CANDIDATES are reranked on
+# the full embedding. Projections are looked up per version and cached.
+COMPACT_SEARCH = os.environ.get("COMPACT_SEARCH", "1") == "1"
+COMPACT_CANDIDATES = int(os.environ.get("COMPACT_CANDIDATES", "40"))
+projections = LRUCache(max_size=100, ttl=300)
+
+# Retrieval fetches CONTEXT_CANDIDATES nearest chunks and packs the closest
+# ones into a prompt of at most CONTEXT_MAX_TOKENS; chunks farther than
+# CONTEXT_MAX_DISTANCE (L2, unset = no cutoff) are left out.
+CONTEXT_CANDIDATES = int(os.environ.get("CONTEXT_CANDIDATES", "10"))
+context_builder = ContextBuilder(
+    chat_encoding(),
+    max_tokens=int(os.environ.get("CONTEXT_MAX_TOKENS", "2000")),
+    max_distance=float(os.environ["CONTEXT_MAX_DISTANCE"]) if os.environ.get("CONTEXT_MAX_DISTANCE") else None,
+    min_excerpt_tokens=int(os.environ.get("CONTEXT_MIN_EXCERPT_TOKENS", "64")),
+    prefill_ms_per_1k=float(os.environ.get("PROMPT_MS_PER_1K_TOKENS", "25")),
+)
+
+# Embeddings are bound as numpy float32 arrays (see vectors.py). The VECTOR
+# type info and whether the server takes binary parameters are looked up on
+# the first pool connection; VECTOR_BINARY=0 forces the text format.
+VECTOR_BINARY = os.environ.get("VECTOR_BINARY", "1") == "1"
+vector_adapter = {}
+
+async def configure_connection(conn):
+    if not vector_adapter:
+        info = await fetch_vector_info(conn)
+        binary = VECTOR_BINARY and info is not None and await aprobe_binary(conn, info)
+        vector_adapter.update(info=info, binary=binary)
+        logger.info("VECTOR parameters use %s format", "binary" if binary else "text")
+    register_vector(conn, vector_adapter["info"], vector_adapter["binary"])
+
+# Database connection. AsyncConnectionPool has to be opened inside the
+# running event loop, so it is created closed and opened in lifespan().
+pool = AsyncConnectionPool(conninfo=os.environ.get("DATABASE_URL"),
+                           kwargs={"application_name": "chatbot",
+                                   "keepalives": 1,
+                                   "keepalives_idle": 60,
+                                   "keepalives_interval": 10,
+                                   "keepalives_count": 5},
+                           min_size=int(os.environ.get("DB_POOL_MIN_SIZE", "4")),
+                           max_size=int(os.environ.get("DB_POOL_MAX_SIZE", "20")),
+                           max_lifetime=600,       # 10 minutes
+                           configure=configure_connection,
+                           open=False
+                           )
+
+# Retrieval reads can go to per-node pools (DATABASE_NODE_URLS, comma
+# separated) routed by READ_ROUTING, and/or run as stale reads with
+# READ_AS_OF, e.g. follower_read_timestamp() or with_max_staleness('10s').
+# Either setting moves retrieval to autocommit read pools (see routing.py);
+# without them it uses the main pool.
+READ_AS_OF = os.environ.get("READ_AS_OF")
+AS_OF = f"AS OF SYSTEM TIME {READ_AS_OF}" if READ_AS_OF else ""
+read_router = None
+if os.environ.get("DATABASE_NODE_URLS") or READ_AS_OF:
+    read_router = ReadRouter(
+        [u.strip() for u in os.environ.get("DATABASE_NODE_URLS", os.environ.get("DATABASE_URL", "")).split(",")
+         if u.strip()],
+        configure=configure_connection,
+        policy=os.environ.get("READ_ROUTING", "least_loaded"),
+        max_size=int(os.environ.get("READ_POOL_MAX_SIZE", "10")),
+        timeout=float(os.environ.get("READ_POOL_TIMEOUT", "2")),
+        health_interval=float(os.environ.get("READ_HEALTH_INTERVAL", "5")))
+
+async def with_read_connection(fn):
+    """await fn(conn) on a connection for retrieval reads."""
+    start = time.perf_counter()
+
+    async def run(conn):
+        record("pool_wait", time.perf_counter() - start)
+        return await fn(conn)
+
+    if read_router is not None:
+        return await read_router.run(run)
+    async with pool.connection() as conn:
+        return await run(conn)
+
+# Connection pools reported on /metrics
+register_pools(lambda: {"main": pool, **({node.name: node.pool for node in read_router.nodes}
+                                         if read_router is not None else {})})
+
+# Admission control (see admission.py). At most ADMISSION_DB_LIMIT requests
+# hold a read connection for retrieval and ADMISSION_LLM_LIMIT run a chat
+# completion at once; the rest wait in bounded queues (ADMISSION_*_QUEUE,
+# ADMISSION_*_MAX_WAIT seconds) and are rejected with 429/503 and Retry-After
+# beyond that. Waiters are ordered by the priority of their key's user_id in
+# ADMISSION_PRIORITIES ("alice=0,batch-jobs=5", lower first), by default
+# ADMISSION_DEFAULT_PRIORITY.
+default_db_limit = (int(os.environ.get("READ_POOL_MAX_SIZE", "10")) * len(read_router.nodes)
+                    if read_router is not None else pool.max_size)
+admission = {
+    "db": Stage("db", limit=int(os.environ.get("ADMISSION_DB_LIMIT", default_db_limit)),
+                max_queue=int(os.environ.get("ADMISSION_DB_QUEUE", "100")),
+                max_wait=float(os.environ.get("ADMISSION_DB_MAX_WAIT", "2"))),
+    "llm": Stage("llm", limit=int(os.environ.get("ADMISSION_LLM_LIMIT", "64")),
+                 max_queue=int(os.environ.get("ADMISSION_LLM_QUEUE", "200")),
+                 max_wait=float(os.environ.get("ADMISSION_LLM_MAX_WAIT", "10"))),
+}
+PRIORITIES = parse_priorities(os.environ.get("ADMISSION_PRIORITIES"))
+DEFAULT_PRIORITY = int(os.environ.get("ADMISSION_DEFAULT_PRIORITY", "1"))
+
+async def admit(stage, priority):
+    """Lease on an admission stage; its queue wait is recorded as "<stage>_queue"."""
+    lease = await admission[stage].acquire(priority)
+    record(f"{stage}_queue", lease.waited)
+    return lease
+
+@asynccontextmanager
+async def admitted(stage, priority):
+    lease = await admit(stage, priority)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+# Startup waits up to STARTUP_WARMUP_TIMEOUT seconds for the pools to fill
+# to min_size, the API keys to load and the embeddings backend to answer
+# once; if it takes longer the warm-up carries on in the background and
+# /ready answers 503 until done.
+STARTUP_WARMUP_TIMEOUT = float(os.environ.get("STARTUP_WARMUP_TIMEOUT", "20"))
+readiness = {"pool": False, "read_router": read_router is None, "embedder": False,
+             "api_keys": False, "warmup_seconds": None}
+
+async def warm_pool():
+    """Open min_size connections (running configure_connection on each) and check them."""
+    async def ping():
+        async with pool.connection() as conn:
+            await conn.execute("SELECT 1")
+    await asyncio.gather(*(ping() for _ in range(pool.min_size)))
+    readiness["pool"] = True
+
+async def warm_read_router():
+    """Ping every read node until at least one answers."""
+    while True:
+        await asyncio.gather(*(read_router.check(node) for node in read_router.nodes))
+        if any(node.healthy for node in read_router.nodes):
+            break
+        await asyncio.sleep(1)
+    readiness["read_router"] = True
+
+async def warm_embedder():
+    """One embeddings request: opens the HTTPS connection to OpenAI (shared with
+    chat completions), or runs the local model's first, slowest forward pass."""
+    await embedder.embed_batch(["warm up"])
+    readiness["embedder"] = True
+
+async def warm_api_keys():
+    """First snapshot of the active keys; until then keys are checked one by one."""
+    await api_keys.refresh()
+    readiness["api_keys"] = True
+
+async def warm_up():
+    start = time.perf_counter()
+
+    async def retry(name, warm):
+        while True:
+            try:
+                return await warm()
+            except Exception as e:
+                logger.warning("%s warm-up failed, retrying: %s", name, e)
+                await asyncio.sleep(2)
+
+    steps = [retry("pool", warm_pool), retry("embedder", warm_embedder),
+             retry("API keys", warm_api_keys)]
+    if read_router is not None:
+        steps.append(retry("read router", warm_read_router))
+    await asyncio.gather(*steps)
+    readiness["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    logger.info("warm after %.2fs", readiness["warmup_seconds"])
+
+@asynccontextmanager
+async def lifespan(app):
+    await pool.open()
+    if read_router is not None:
+        await read_router.open()
+    warmup = asyncio.create_task(warm_up())
+    await asyncio.wait({warmup}, timeout=STARTUP_WARMUP_TIMEOUT)
+    tasks = [warmup, asyncio.create_task(api_keys.run())]
+    if local_index is not None:
+        tasks.append(asyncio.create_task(local_index.run(pool)))
+    if read_router is not None:
+        tasks.append(asyncio.create_task(read_router.run_health_checks()))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        if read_router is not None:
+            await read_router.close()
+        await pool.close()
+        await client.close()
+
 # Initialize FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,18 +278,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Stage timings of /rag requests: Server-Timing header and /metrics histograms
+app.add_middleware(ServerTimingMiddleware, paths=("/rag",))
 
-# Database connection
-pool = ConnectionPool(conninfo=os.environ.get("DATABASE_URL"),
-                      kwargs={"application_name": "chatbot",
-                              "keepalives": 1,
-                              "keepalives_idle": 60,
-                              "keepalives_interval": 10,
-                              "keepalives_count": 5},
-                      max_lifetime=600        # 10 minutes
-                      )
-
-def generate_response(question):
+async def generate_response(question):
     
     SYSTEM_PROMPT = """
     Human: You are an AI assistant. You are able to find answers to the questions from the contextual passage snippets provided.
@@ -58,7 +292,7 @@ def generate_response(question):
     {question}
     </question>
     """
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=[
             {"role": "system", "content": SYSTEM_PROMPT},
@@ -69,55 +303,179 @@ def generate_response(question):
     return {"answer": answer}
 
 
-def retrieve_similar_texts(query, crdb_ver, conn, k=3):
-    """Retrieve the top-k most similar texts from pgvector."""
-    # embedding = model.encode(query).tolist()
-    response = client.embeddings.create(
-        input=[query],
-        model="text-embedding-ada-002"  # This is the current recommended embedding model
-    )
+async def embed_query(query):
+    """Embed a single question with the configured backend."""
+    return (await embedder.embed([query]))[0]
 
-    # Extract the embedding vector
-    embedding = response.data[0].embedding
+async def retrieve_candidates_batch(conn, queries, n):
+    """retrieve_candidates for many (embedding, version) queries, in order.
 
-    embedding_str = f"[{','.join(map(str, embedding))}]"  # Format for SQL
+    Queries the local index can't answer are searched together in one
+    round-trip: a LATERAL top-n subquery per row of a VALUES list.
+    """
+    results = [None] * len(queries)
+    if local_index is not None:
+        for i, (embedding, version) in enumerate(queries):
+            hits = await asyncio.to_thread(local_index.search, version, embedding, n)
+            if hits is not None:
+                results[i] = [(id_, distance, None) for id_, distance in hits]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
 
-    # print (embedding_str)
-    with conn.cursor() as cursor:
-        cursor.execute(f"""
-            SELECT url, text, embedding <-> %s AS distance, id
-            FROM embeddings
-            WHERE version = %s
-            ORDER BY embedding <-> %s
-            LIMIT %s;
-        """, (embedding_str, crdb_ver, embedding_str, k))
-        logger.debug(f"""
-            SELECT url, text, embedding <-> %s AS distance, id
+    values = ", ".join(["(%s::INT, %s::VECTOR, %s::STRING)"] * len(pending))
+    query = f"""
+        SELECT q.i, c.id, c.distance, c.tokens
+        FROM (VALUES {values}) AS q (i, q_embedding, q_version),
+        LATERAL (
+            SELECT id, embedding <-> q.q_embedding AS distance, tokens
             FROM embeddings
-            WHERE version = %s
-            ORDER BY embedding <-> %s
-            LIMIT %s;
-        """, (embedding_str, crdb_ver, embedding_str, k))
-        results = cursor.fetchall()
+            WHERE version = q.q_version
+            ORDER BY embedding <-> q.q_embedding
+            LIMIT %s
+        ) AS c {AS_OF}
+        ORDER BY q.i, c.distance;
+    """
+    params = [v for i in pending for v in (i, to_vector(queries[i][0]), queries[i][1])]
+    async with conn.cursor() as cursor:
+        await cursor.execute(query, params + [n])
+        rows = await cursor.fetchall()
+    for i in pending:
+        results[i] = []
+    for i, id_, distance, tokens in rows:
+        results[i].append((id_, distance, tokens))
     return results
 
-def generate_rag_response(conn, question, k=3):
+async def retrieve_batch(conn, queries, k=3):
+    """[(cached response or None, rows, context stats)] for many (embedding, version) queries.
 
-    """Retrieve relevant documents and generate a response using GPT, showing source IDs."""
-    retrieved_texts = retrieve_similar_texts(question, "v25.2", conn, k)
+    Answer cache hits are validated one by one as in /rag; the rest share
+    one candidate search and one text fetch.
+    """
+    results = [None] * len(queries)
+    for i, (embedding, version) in enumerate(queries):
+        cached = await answer_cache.lookup(conn, version, k, embedding)
+        if cached is not None:
+            results[i] = (cached, [], {})
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
 
-    if not retrieved_texts:
-        return {"answer": "I couldn't find relevant information in the database.", "sources": []}
+    with timed("search"):
+        candidates = await retrieve_candidates_batch(conn, [queries[i] for i in pending],
+                                                     max(CONTEXT_CANDIDATES, k))
+        chosen = [context_builder.choose(c, k) for c in candidates]
+        texts = await fetch_texts(conn, {id_ for hits, _ in chosen for id_, _ in hits})
+    for i, (hits, stats) in zip(pending, chosen):
+        results[i] = (None, chunk_rows(texts, hits), stats)
+    return results
 
-    # print(context)
-    # Extract IDs and texts separately
-    urls = [str(row[0]) for row in retrieved_texts]
-    texts = [row[1] for row in retrieved_texts]
-    ids = [str(row[3]) for row in retrieved_texts]
+async def get_query_embedding(query):
+    """Embedding of a question; repeated questions are served from the cache without an API round-trip."""
+    # embedding = model.encode(query).tolist()
+    with timed("embed"):
+        return await embedding_cache.get_or_embed(query, embedder.name, embed_query)
 
+async def fetch_texts(conn, ids):
+    """{id: (url, text, updated)} of the chunks with the given ids."""
+    async with conn.cursor() as cursor:
+        await cursor.execute(
+            f"SELECT id, url, text, crdb_internal_mvcc_timestamp FROM embeddings {AS_OF} "
+            "WHERE id = ANY(%s::UUID[])",
+            ([str(id_) for id_ in ids],))
+        return {row[0]: row[1:] for row in await cursor.fetchall()}
+
+def chunk_rows(texts, hits):
+    """Rows (url, text, distance, id, updated) of hits [(id, distance)], in order."""
+    # Chunks deleted since the local index was refreshed are skipped
+    return [(texts[id_][0], texts[id_][1], distance, id_, texts[id_][2])
+            for id_, distance in hits if id_ in texts]
+
+async def fetch_chunks(conn, hits):
+    """Rows (url, text, distance, id, updated) of the chunks in hits [(id, distance)], in order."""
+    return chunk_rows(await fetch_texts(conn, [id_ for id_, _ in hits]), hits)
+
+async def get_projection(conn, version):
+    """Projection of version for the compact column, or None (cached either way)."""
+    cached = projections.get(version)
+    if cached is None:
+        try:
+            cached = (await aload_projection(conn, version),)
+        except Exception as e:
+            # tables created without --compact-dimensions have no embedding_projections
+            logger.debug("no compact projection for %s: %s", version, e)
+            await conn.rollback()
+            cached = (None,)
+        projections.put(version, cached)
+    return cached[0]
+
+async def retrieve_compact(embedding, projection, crdb_ver, conn, n):
+    """Candidates from the embedding_compact index, reranked on the full embedding."""
+    query = f"""
+        WITH candidates AS (
+            SELECT id FROM embeddings
+            WHERE version = %(version)s
+            ORDER BY embedding_compact <-> %(compact)s
+            LIMIT %(candidates)s
+        )
+        SELECT id, embedding <-> %(embedding)s AS distance, tokens
+        FROM embeddings {AS_OF}
+        WHERE id IN (SELECT id FROM candidates)
+        ORDER BY distance
+        LIMIT %(n)s;
+    """
+    async with conn.cursor() as cursor:
+        await cursor.execute(query, {"embedding": to_vector(embedding),
+                                     "compact": projection.project(embedding),
+                                     "version": crdb_ver, "n": n,
+                                     "candidates": max(COMPACT_CANDIDATES, n)},
+                             prepare=True)
+        return await cursor.fetchall()
+
+async def retrieve_candidates(embedding, crdb_ver, conn, n):
+    """The n nearest chunks as (id, distance, tokens), closest first, without their text."""
+    if local_index is not None:
+        hits = await asyncio.to_thread(local_index.search, crdb_ver, embedding, n)
+        if hits is not None:
+            return [(id_, distance, None) for id_, distance in hits]
+    if COMPACT_SEARCH:
+        projection = await get_projection(conn, crdb_ver)
+        if projection is not None:
+            return await retrieve_compact(embedding, projection, crdb_ver, conn, n)
+
+    # The vector is bound once as $1 and referenced twice; prepare=True keeps
+    # the plan server-side so repeated questions only send parameters.
+    query = f"""
+        SELECT id, embedding <-> %(embedding)s AS distance, tokens
+        FROM embeddings {AS_OF}
+        WHERE version = %(version)s
+        ORDER BY embedding <-> %(embedding)s
+        LIMIT %(n)s;
+    """
+    async with conn.cursor() as cursor:
+        await cursor.execute(query, {"embedding": to_vector(embedding), "version": crdb_ver, "n": n},
+                             prepare=True)
+        logger.debug("%s version=%s n=%s", query, crdb_ver, n)
+        return await cursor.fetchall()
+
+async def retrieve_similar_texts(embedding, crdb_ver, conn, k=3):
+    """Retrieve up to k similar chunks that fit the context budget.
+
+    Returns (rows, stats); rows are (url, text, distance, id, updated). Text
+    is only fetched for the candidates the context builder keeps.
+    """
+    with timed("search"):
+        candidates = await retrieve_candidates(embedding, crdb_ver, conn, max(CONTEXT_CANDIDATES, k))
+        chosen, stats = context_builder.choose(candidates, k)
+        if not chosen:
+            return [], stats
+        return await fetch_chunks(conn, chosen), stats
+
+def build_messages(question, texts):
+    """Chat messages asking the model to answer question from the retrieved texts."""
     # Combine retrieved texts for the prompt
     context = "\n".join(texts)
-    
+
     SYSTEM_PROMPT = """
     Human: You are an AI assistant. You are able to find answers to the questions from the contextual passage snippets provided.
     """
@@ -130,41 +488,312 @@ def generate_rag_response(conn, question, k=3):
     {question}
     </question>
     """
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": USER_PROMPT},
-        ],
-    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": USER_PROMPT},
+    ]
+
+async def retrieve_for_question(conn, embedding, version, k=3):
+    """Return (cached response or None, retrieved rows, context stats) for a question's embedding."""
+    # A near-paraphrase of an earlier question skips retrieval and the LLM call
+    cached = await answer_cache.lookup(conn, version, k, embedding)
+    if cached is not None:
+        return cached, [], {}
+
+    retrieved_texts, stats = await retrieve_similar_texts(embedding, version, conn, k)
+    return None, retrieved_texts, stats
+
+async def complete_answer(question, version, k, embedding, retrieved_texts, stats):
+    """Answer a question from its retrieved rows with one completion, and cache the answer."""
+    # Fit the chunks into the prompt's token budget
+    texts, retrieved_texts, context = context_builder.pack(retrieved_texts, stats)
+    if not retrieved_texts:
+        return {"answer": NO_CONTEXT_ANSWER, "sources": [], "context": context}
+
+    # print(context)
+    # Extract IDs and texts separately
+    urls = [str(row[0]) for row in retrieved_texts]
+    ids = [str(row[3]) for row in retrieved_texts]
+
+    with timed("llm"):
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=build_messages(question, texts),
+        )
     answer = response.choices[0].message.content
-    return {"answer": answer, "urls": urls, "ids": ids}
+    record_usage(response.usage, context["context_tokens"])
+    if response.usage is not None:
+        context["prompt_tokens"] = response.usage.prompt_tokens
+    logger.info("context: %s", context)
+    result = {"answer": answer, "urls": urls, "ids": ids, "context": context}
+    answer_cache.put(version, k, embedding, {str(row[3]): row[4] for row in retrieved_texts}, result)
+    return result
 
-def validate_api_key(api_key: str) -> bool:
-    with pool.connection() as conn:
-        with conn.cursor() as cursor:
-            try:
-                query = """
-                SELECT * FROM api_keys
-                WHERE key = %s AND is_active = TRUE
-                LIMIT 1;
-                """
-                cursor.execute(query, (api_key,))
-                result = cursor.fetchone()
-                logger.debug(f"query is {query} and key is {api_key}")
-                return result is not None  # True if key is valid and active
+async def generate_rag_response(question, k=3, version=DEFAULT_VERSION, priority=DEFAULT_PRIORITY):
+    """Retrieve relevant documents and generate a response using GPT, showing source IDs.
 
-            except Exception as e:
-                print(f"[ERROR] API key validation failed: {e}")
-                return False
- 
-def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
-    if not validate_api_key(credentials.credentials):
+    The read connection is back in the pool before the completion starts, so
+    requests waiting on OpenAI don't hold one.
+    """
+    embedding = await get_query_embedding(question)
+    async with admitted("db", priority):
+        cached, retrieved_texts, stats = await with_read_connection(
+            lambda conn: retrieve_for_question(conn, embedding, version, k))
+    if cached is not None:
+        return cached
+    async with admitted("llm", priority):
+        return await complete_answer(question, version, k, embedding, retrieved_texts, stats)
+
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_rag_response(question, embedding, db_lease, k=3, version=DEFAULT_VERSION):
+    """Server-sent events for a question: sources first, then answer tokens as they arrive.
+
+    The pool connection and db_lease are only held for retrieval, not while
+    tokens stream.
+    """
+    try:
+        cached, retrieved_texts, stats = await with_read_connection(
+            lambda conn: retrieve_for_question(conn, embedding, version, k))
+    except Exception as e:
+        logger.error("retrieval failed: %s", e)
+        yield sse_event("error", {"detail": "retrieval failed"})
+        return
+    finally:
+        db_lease.release()
+
+    if cached is not None:
+        yield sse_event("sources", {"urls": cached.get("urls", []), "ids": cached.get("ids", []),
+                                    "cached": True})
+        yield sse_event("token", {"text": cached["answer"]})
+        yield sse_event("done", {})
+        return
+
+    texts, retrieved_texts, context = context_builder.pack(retrieved_texts, stats)
+    if not retrieved_texts:
+        yield sse_event("sources", {"urls": [], "ids": [], "context": context})
+        yield sse_event("token", {"text": NO_CONTEXT_ANSWER})
+        yield sse_event("done", {})
+        return
+
+    urls = [str(row[0]) for row in retrieved_texts]
+    ids = [str(row[3]) for row in retrieved_texts]
+    logger.info("context: %s", context)
+    yield sse_event("sources", {"urls": urls, "ids": ids, "context": context})
+
+    parts = []
+    try:
+        with timed("llm"):
+            stream = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=build_messages(question, texts),
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                # the last chunk carries the token usage and no choices
+                if not chunk.choices:
+                    record_usage(chunk.usage, context["context_tokens"])
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield sse_event("token", {"text": delta})
+    except Exception as e:
+        logger.error("completion stream failed: %s", e)
+        yield sse_event("error", {"detail": "completion failed"})
+        return
+
+    result = {"answer": "".join(parts), "urls": urls, "ids": ids}
+    answer_cache.put(version, k, embedding, {str(row[3]): row[4] for row in retrieved_texts}, result)
+    yield sse_event("done", {})
+
+async def validate_api_key(api_key: str) -> bool:
+    """Check a single key against the database; only used while the key snapshot is stale."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            query = """
+            SELECT * FROM api_keys
+            WHERE key = %s AND is_active = TRUE
+            LIMIT 1;
+            """
+            await cursor.execute(query, (api_key,))
+            result = await cursor.fetchone()
+            logger.debug(f"query is {query} and key is {api_key}")
+            return result is not None  # True if key is valid and active
+
+async def load_active_api_keys():
+    """Map of every active key to its user_id, reloaded in the background."""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT key, user_id FROM api_keys WHERE is_active = TRUE;")
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+# Key checks are answered from memory; API_KEY_MAX_STALENESS bounds how long
+# a revoked key can keep working.
+api_keys = api_key_cache_from_env(load_active_api_keys, validate_api_key)
+
+async def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
+    with timed("key"):
+        valid = await api_keys.is_valid(credentials.credentials)
+    if not valid:
         raise HTTPException(status_code=403, detail="Invalid API Key")
-   
+    return credentials.credentials
+
+def request_priority(api_key):
+    """Admission priority of a request made with api_key."""
+    return PRIORITIES.get(api_keys.user_id(api_key), DEFAULT_PRIORITY)
+
+async def answer_question(question, k=3, version=DEFAULT_VERSION, priority=DEFAULT_PRIORITY):
+    """generate_rag_response, shared by identical concurrent questions.
+
+    The leader's stages are timed in its own request; a request that joins it
+    records its wait as the "coalesced" stage.
+    """
+
+    async def run():
+        return await generate_rag_response(question, k, version, priority)
+
+    key = (normalize_question(question), version, k)
+    if rag_inflight.running(key):
+        with timed("coalesced"):
+            return await rag_inflight.do(key, run)
+    return await rag_inflight.do(key, run)
+
+async def answer_batch(questions, k=3, priority=DEFAULT_PRIORITY):
+    """NDJSON lines with the answers of questions [(question, version)], as they complete.
+
+    The questions are embedded with one call and retrieved on one connection
+    before the response starts; completions then run BATCH_CONCURRENCY at a
+    time with no connection held, each admitted to the LLM stage on its own.
+    """
+    with timed("embed"):
+        embeddings = await embedding_cache.get_or_embed_many([q for q, _ in questions], embedder.name,
+                                                             embedder.embed_batch)
+    queries = [(embedding, version) for embedding, (_, version) in zip(embeddings, questions)]
+    async with admitted("db", priority):
+        retrieved = await with_read_connection(lambda conn: retrieve_batch(conn, queries, k))
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def answer(i):
+        question, version = questions[i]
+        cached, rows, stats = retrieved[i]
+        line = {"index": i, "question": question, "version": version}
+        try:
+            if cached is not None:
+                return {**line, **cached}
+            async with semaphore, admitted("llm", priority):
+                return {**line, **await complete_answer(question, version, k, embeddings[i], rows, stats)}
+        except Rejected as e:
+            return {**line, "error": "overloaded", "retry_after": e.retry_after}
+        except Exception as e:
+            logger.error("batch completion %s failed: %s", i, e)
+            return {**line, "error": "completion failed"}
+
+    async def lines():
+        tasks = [asyncio.ensure_future(answer(i)) for i in range(len(questions))]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task) + "\n"
+        finally:
+            # A client that went away stops the rest of its searches and completions
+            for task in tasks:
+                task.cancel()
+
+    return lines()
+
+class BatchQuestion(BaseModel):
+    question: str
+    version: str = DEFAULT_VERSION
+
+class BatchRequest(BaseModel):
+    questions: list[BatchQuestion]
+    k: int = Field(3, ge=1, le=BATCH_MAX_K)
+
+class LeasedStreamingResponse(StreamingResponse):
+    """StreamingResponse that releases admission leases once the body is sent or abandoned."""
+
+    def __init__(self, content, leases, **kwargs):
+        super().__init__(content, **kwargs)
+        self.leases = leases
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            for lease in self.leases:
+                lease.release()
+
+@app.exception_handler(Rejected)
+async def rejected_handler(request, exc):
+    """Over-limit requests fail fast: 429 when a queue is full, 503 after waiting too long."""
+    return JSONResponse(status_code=exc.status,
+                        content={"detail": f"overloaded: {exc}", "retry_after": exc.retry_after},
+                        headers={"Retry-After": str(exc.retry_after)})
+
 @app.get("/rag")
-def query_rag(question: str, api_check: bool = Depends(verify_api_key)):
+async def query_rag(question: str, version: str = DEFAULT_VERSION,
+                    api_key: str = Depends(verify_api_key)):
     """API endpoint for querying the RAG system."""
-    with pool.connection() as conn:
-        response = generate_rag_response(conn, question)
-    return response
+    return await answer_question(question, version=version, priority=request_priority(api_key))
+
+@app.post("/rag/batch")
+async def query_rag_batch(request: BatchRequest, api_key: str = Depends(verify_api_key)):
+    """Answer many questions; one JSON object per line ({index, question, version, answer, ...}),
+    in completion order."""
+    if len(request.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400,
+                            detail=f"at most {BATCH_MAX_QUESTIONS} questions per batch")
+    lines = await answer_batch([(q.question, q.version) for q in request.questions], request.k,
+                               request_priority(api_key))
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@app.get("/rag/stream")
+async def query_rag_stream(question: str, version: str = DEFAULT_VERSION,
+                           api_key: str = Depends(verify_api_key)):
+    """Streaming variant of /rag as server-sent events (sources, token..., done).
+
+    Both stages are admitted before the response starts, so an overloaded
+    server answers 429/503 rather than an event stream that fails later. The
+    llm lease is taken first: waiting in the llm queue while holding a db
+    slot would starve retrieval for everyone else.
+    """
+    priority = request_priority(api_key)
+    embedding = await get_query_embedding(question)
+    llm_lease = await admit("llm", priority)
+    try:
+        db_lease = await admit("db", priority)
+    except BaseException:
+        llm_lease.release()
+        raise
+    return LeasedStreamingResponse(stream_rag_response(question, embedding, db_lease, version=version),
+                                   [db_lease, llm_lease],
+                                   media_type="text/event-stream",
+                                   headers={"Cache-Control": "no-cache",
+                                            "X-Accel-Buffering": "no"})
+
+@app.get("/stats")
+async def stats(api_check: str = Depends(verify_api_key)):
+    """Cache hit/miss and admission counters for this worker."""
+    return {"embedding_backend": embedder.stats(),
+            "embedding_cache": embedding_cache.stats(),
+            "answer_cache": answer_cache.stats(),
+            "single_flight": rag_inflight.stats(),
+            "local_index": local_index.stats() if local_index is not None else None,
+            "read_router": read_router.stats() if read_router is not None else None,
+            "api_keys": api_keys.stats(),
+            "admission": {name: stage.stats() for name, stage in admission.items()}}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics of this worker: stage latencies, tokens and pool saturation."""
+    body, content_type = render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once the pools, API keys and the embeddings backend are warm, else 503."""
+    warm = readiness["pool"] and readiness["read_router"] and readiness["embedder"] and readiness["api_keys"]
+    return JSONResponse(status_code=200 if warm else 503, content={"ready": warm, **readiness})
@@ -0,0 +1,411 @@
+# coding: utf-8
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(text):
+    """Case- and whitespace-insensitive form of a question, used as cache key."""
+    return " ".join(text.lower().split())
+
+
+class LRUCache:
+    """Small in-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SharedEmbeddingStore:
+    """On-disk embedding store shared by every uvicorn worker on the host.
+
+    Backed by a SQLite file in WAL mode; each thread keeps its own connection.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""CREATE TABLE IF NOT EXISTS query_embeddings (
+                            model TEXT NOT NULL,
+                            question TEXT NOT NULL,
+                            embedding BLOB NOT NULL,
+                            created_at REAL NOT NULL,
+                            PRIMARY KEY (model, question)
+                        )""")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, model, question):
+        row = self._conn().execute(
+            "SELECT embedding FROM query_embeddings "
+            "WHERE model = ? AND question = ? AND created_at > ?",
+            (model, question, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, model, question, embedding):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)",
+                     (model, question, np.asarray(embedding, dtype=np.float32).tobytes(),
+                      time.time()))
+        conn.commit()
+
+
+class EmbeddingCache:
+    """Two-tier cache of question embeddings keyed by (model, normalized question).
+
+    The first tier is a per-process LRU, the optional second tier a store
+    shared across workers. A hit in either tier skips the embeddings API call.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600, shared=None):
+        self.memory = LRUCache(max_size, ttl)
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    async def get_or_embed(self, text, model, embed):
+        """Return the cached embedding for text, calling `await embed(text)` on a miss."""
+        key = (model, normalize_question(text))
+        embedding = self.memory.get(key)
+        if embedding is not None:
+            self.hits += 1
+            return embedding
+
+        if self.shared is not None:
+            try:
+                embedding = await asyncio.to_thread(self.shared.get, *key)
+            except sqlite3.Error as e:
+                logger.warning("shared embedding cache read failed: %s", e)
+            if embedding is not None:
+                self.shared_hits += 1
+                self.memory.put(key, embedding)
+                return embedding
+
+        self.misses += 1
+        embedding = np.asarray(await embed(text), dtype=np.float32)
+        self.memory.put(key, embedding)
+        if self.shared is not None:
+            try:
+                await asyncio.to_thread(self.shared.put, *key, embedding)
+            except sqlite3.Error as e:
+                logger.warning("shared embedding cache write failed: %s", e)
+        return embedding
+
+    async def get_or_embed_many(self, texts, model, embed_many):
+        """Embeddings of texts in order; the misses are embedded with one `await embed_many(texts)`."""
+        keys = [(model, normalize_question(text)) for text in texts]
+        found = {}
+        for key in dict.fromkeys(keys):
+            embedding = self.memory.get(key)
+            if embedding is None and self.shared is not None:
+                try:
+                    embedding = await asyncio.to_thread(self.shared.get, *key)
+                except sqlite3.Error as e:
+                    logger.warning("shared embedding cache read failed: %s", e)
+                if embedding is not None:
+                    self.shared_hits += 1
+                    self.memory.put(key, embedding)
+            elif embedding is not None:
+                self.hits += 1
+            if embedding is not None:
+                found[key] = embedding
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            self.misses += len(missing)
+            vectors = np.asarray(await embed_many(list(missing.values())), dtype=np.float32)
+            for key, embedding in zip(missing, vectors):
+                found[key] = embedding
+                self.memory.put(key, embedding)
+                if self.shared is not None:
+                    try:
+                        await asyncio.to_thread(self.shared.put, *key, embedding)
+                    except sqlite3.Error as e:
+                        logger.warning("shared embedding cache write failed: %s", e)
+        return [found[key] for key in keys]
+
+    def stats(self):
+        return {"hits": self.hits, "shared_hits": self.shared_hits,
+                "misses": self.misses, "size": len(self.memory)}
+
+
+def embedding_cache_from_env():
+    shared = None
+    path = os.environ.get("EMBED_CACHE_PATH")
+    if path:
+        shared = SharedEmbeddingStore(path, ttl=float(os.environ.get("EMBED_CACHE_SHARED_TTL", "86400")))
+    return EmbeddingCache(max_size=int(os.environ.get("EMBED_CACHE_SIZE", "1024")),
+                          ttl=float(os.environ.get("EMBED_CACHE_TTL", "3600")),
+                          shared=shared)
+
+
+class SemanticCache:
+    """Answers of past questions, looked up by embedding distance.
+
+    A new question whose embedding is within `max_distance` (L2, the same
+    metric as the retrieval query) of a cached one for the same version and
+    number of retrieved chunks `k` gets the cached answer. Each entry
+    remembers the MVCC timestamps of the `embeddings` rows it was built from
+    and is dropped as soon as any of them is updated or deleted.
+    """
+
+    def __init__(self, max_distance=0.2, max_size=1000, ttl=86400):
+        self.max_distance = max_distance
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = {}   # (version, k) -> list of entries, oldest first
+        self._matrices = {}  # (version, k) -> stacked embeddings, rebuilt lazily
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _matrix(self, key):
+        matrix = self._matrices.get(key)
+        if matrix is None:
+            matrix = np.stack([e["embedding"] for e in self._entries[key]])
+            self._matrices[key] = matrix
+        return matrix
+
+    def _remove(self, key, entry):
+        # Entries hold numpy arrays, so match by identity rather than ==
+        entries = self._entries.get(key, [])
+        for i, e in enumerate(entries):
+            if e is entry:
+                del entries[i]
+                self._matrices.pop(key, None)
+                break
+        if not entries:
+            self._entries.pop(key, None)
+
+    def _evict_expired(self, key):
+        entries = self._entries[key]
+        now = time.monotonic()
+        live = [e for e in entries if e["expires_at"] >= now]
+        if len(live) < len(entries):
+            self._matrices.pop(key, None)
+            if live:
+                self._entries[key] = live
+            else:
+                del self._entries[key]
+
+    def nearest(self, version, k, embedding):
+        """Closest live entry within max_distance, or None."""
+        key = (version, k)
+        if self.max_size <= 0 or key not in self._entries:
+            return None
+        # Expired entries go first, so they can't hide a live one that is a bit farther
+        self._evict_expired(key)
+        if key not in self._entries:
+            return None
+        distances = np.linalg.norm(self._matrix(key) - embedding, axis=1)
+        i = int(np.argmin(distances))
+        if distances[i] > self.max_distance:
+            return None
+        return self._entries[key][i]
+
+    async def lookup(self, conn, version, k, embedding):
+        """Return a cached response for a nearby question, validated against the table."""
+        entry = self.nearest(version, k, embedding)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        # One point lookup by primary key, much cheaper than the LLM call it saves
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT id, crdb_internal_mvcc_timestamp FROM embeddings WHERE id = ANY(%s::UUID[])",
+                (list(entry["rows"]),))
+            current = {str(row[0]): row[1] for row in await cursor.fetchall()}
+        if current != entry["rows"]:
+            self.invalidations += 1
+            self.misses += 1
+            self._remove((version, k), entry)
+            return None
+
+        self.hits += 1
+        # The context report described the original request; this one sent no prompt
+        response = {**entry["response"], "cached": True}
+        if "context" in response:
+            response["context"] = {"cached": True}
+        return response
+
+    def put(self, version, k, embedding, rows, response):
+        """Cache response for a question; rows maps source id -> MVCC timestamp."""
+        if self.max_size <= 0:
+            return
+        key = (version, k)
+        entries = self._entries.setdefault(key, [])
+        entries.append({"embedding": np.asarray(embedding, dtype=np.float32),
+                        "rows": dict(rows),
+                        "response": dict(response),
+                        "expires_at": time.monotonic() + self.ttl})
+        if len(entries) > self.max_size:
+            del entries[0]
+        self._matrices.pop(key, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations,
+                "size": sum(len(e) for e in self._entries.values())}
+
+
+def semantic_cache_from_env():
+    return SemanticCache(max_distance=float(os.environ.get("SEMANTIC_CACHE_DISTANCE", "0.2")),
+                         max_size=int(os.environ.get("SEMANTIC_CACHE_SIZE", "1000")),
+                         ttl=float(os.environ.get("SEMANTIC_CACHE_TTL", "86400")))
+
+
+class SingleFlight:
+    """Shares one in-flight call among concurrent callers with the same key.
+
+    The first caller for a key starts `make()` as a task; callers arriving
+    before it finishes await the same task instead of starting their own. A
+    caller that is cancelled (e.g. the client went away) does not cancel the
+    work for the others.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.leaders = 0
+        self.joined = 0
+
+    async def do(self, key, make):
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(make())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.joined += 1
+        return await asyncio.shield(task)
+
+    def running(self, key):
+        """Whether a call for key is in flight, i.e. do(key, ...) would join it."""
+        return key in self._inflight
+
+    def stats(self):
+        return {"leaders": self.leaders, "joined": self.joined, "in_flight": len(self._inflight)}
+
+
+class ApiKeyCache:
+    """In-memory view of the active API keys.
+
+    The full set of active keys is reloaded every `refresh_interval` seconds by
+    a background task, so while that snapshot is younger than `max_staleness`
+    a key check never touches the database and revocations take effect within
+    one refresh. If the snapshot goes stale (e.g. refreshes are failing), keys
+    are checked individually with `validate` and the results kept for
+    `positive_ttl` / `negative_ttl` seconds, so repeated bad keys still don't
+    hammer the database.
+    """
+
+    def __init__(self, load_active, validate, refresh_interval=30, max_staleness=120,
+                 positive_ttl=60, negative_ttl=30, max_size=10000):
+        self.load_active = load_active
+        self.validate = validate
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self._active = {}
+        self._loaded_at = None
+        self._positive = LRUCache(max_size, positive_ttl)
+        self._negative = LRUCache(max_size, negative_ttl)
+        self.snapshot_checks = 0
+        self.fallback_checks = 0
+
+    def fresh(self):
+        return (self._loaded_at is not None
+                and time.monotonic() - self._loaded_at <= self.max_staleness)
+
+    async def refresh(self):
+        self._active = await self.load_active()
+        self._loaded_at = time.monotonic()
+
+    async def run(self):
+        """Background loop that keeps the snapshot of active keys current."""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("API key refresh failed: %s", e)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def is_valid(self, api_key):
+        if self.fresh():
+            self.snapshot_checks += 1
+            return api_key in self._active
+
+        self.fallback_checks += 1
+        if self._positive.get(api_key) is not None:
+            return True
+        if self._negative.get(api_key) is not None:
+            return False
+        try:
+            valid = await self.validate(api_key)
+        except Exception as e:
+            # Don't cache a failed lookup as a bad key
+            logger.error("API key validation failed: %s", e)
+            return False
+        (self._positive if valid else self._negative).put(api_key, True)
+        return valid
+
+    def user_id(self, api_key):
+        """user_id of a key in the last snapshot, or None."""
+        return self._active.get(api_key)
+
+    def stats(self):
+        age = None if self._loaded_at is None else round(time.monotonic() - self._loaded_at, 1)
+        return {"active_keys": len(self._active), "snapshot_age": age,
+                "snapshot_checks": self.snapshot_checks,
+                "fallback_checks": self.fallback_checks}
+
+
+def api_key_cache_from_env(load_active, validate):
+    return ApiKeyCache(load_active, validate,
+                       refresh_interval=float(os.environ.get("API_KEY_REFRESH_INTERVAL", "30")),
+                       max_staleness=float(os.environ.get("API_KEY_MAX_STALENESS", "120")),
+                       positive_ttl=float(os.environ.get("API_KEY_POSITIVE_TTL", "60")),
+                       negative_ttl=float(os.environ.get("API_KEY_NEGATIVE_TTL", "30")))
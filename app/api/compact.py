@@ -0,0 +1,94 @@
+# coding: utf-8
+"""Reduced-dimension copies of the embeddings for the candidate search.
+
+`embeddings.embedding_compact` holds every chunk's embedding projected to a
+few hundred dimensions, and the vector index on it finds candidates that are
+then reranked against the full-precision `embedding` column. A version's
+projection is stored in `embedding_projections` so the loader and the API
+project the same way:
+
+- "pca": the top principal components, fit on the version's embeddings;
+- "truncate": the first n dimensions, for models trained to be shortened
+  (text-embedding-3-*, the same as the API's `dimensions` parameter).
+
+Projected vectors are L2-normalized.
+"""
+import numpy as np
+
+KINDS = ("pca", "truncate")
+
+
+class Projection:
+
+    def __init__(self, kind, dimensions, mean=None, components=None):
+        if kind not in KINDS:
+            raise ValueError(f"unknown projection: {kind}")
+        self.kind = kind
+        self.dimensions = dimensions
+        self.mean = mean
+        self.components = components  # (dimensions, source dimensions)
+
+    def project(self, vectors):
+        """(n, d) or (d,) float32 embeddings -> L2-normalized (n, dimensions) or (dimensions,)."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.kind == "truncate":
+            out = vectors[..., :self.dimensions]
+        else:
+            out = (vectors - self.mean) @ self.components.T
+        norms = np.linalg.norm(out, axis=-1, keepdims=True)
+        return (out / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    def to_row(self):
+        """(kind, dimensions, mean, components) as stored in embedding_projections."""
+        if self.kind == "truncate":
+            return self.kind, self.dimensions, None, None
+        return (self.kind, self.dimensions, self.mean.astype("<f4").tobytes(),
+                self.components.astype("<f4").tobytes())
+
+    @classmethod
+    def from_row(cls, kind, dimensions, mean, components):
+        if kind == "truncate":
+            return cls(kind, dimensions)
+        mean = np.frombuffer(mean, dtype="<f4").astype(np.float32)
+        components = np.frombuffer(components, dtype="<f4").astype(np.float32).reshape(dimensions, len(mean))
+        return cls(kind, dimensions, mean, components)
+
+
+def fit_pca(vectors, dimensions, max_samples=50000, seed=0):
+    """Projection onto the top `dimensions` principal components of (a sample of) vectors."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) > max_samples:
+        vectors = vectors[np.random.default_rng(seed).choice(len(vectors), max_samples, replace=False)]
+    if len(vectors) < dimensions:
+        raise ValueError(f"PCA to {dimensions} dimensions needs at least {dimensions} embeddings, got {len(vectors)}")
+    mean = vectors.mean(axis=0)
+    # Eigenvectors of the covariance; cheaper than an SVD of the samples when n >> d
+    centered = vectors - mean
+    _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+    components = eigenvectors[:, ::-1][:, :dimensions].T
+    return Projection("pca", dimensions, mean, np.ascontiguousarray(components, dtype=np.float32))
+
+
+PROJECTION_QUERY = ("SELECT kind, dimensions, mean, components FROM embedding_projections "
+                    "WHERE version = %s")
+
+
+def load_projection(conn, version):
+    """Stored Projection of version, or None."""
+    with conn.cursor() as cur:
+        cur.execute(PROJECTION_QUERY, (version,))
+        row = cur.fetchone()
+    return Projection.from_row(*row) if row is not None else None
+
+
+async def aload_projection(conn, version):
+    """Async variant of load_projection."""
+    async with conn.cursor() as cur:
+        await cur.execute(PROJECTION_QUERY, (version,))
+        row = await cur.fetchone()
+    return Projection.from_row(*row) if row is not None else None
+
+
+def store_projection(cur, version, projection):
+    cur.execute("UPSERT INTO embedding_projections (version, kind, dimensions, mean, components) "
+                "VALUES (%s, %s, %s, %s, %s)", (version, *projection.to_row()))
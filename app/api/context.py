@@ -0,0 +1,84 @@
+# coding: utf-8
+"""Picks and packs retrieved chunks into the LLM prompt under a token budget.
+
+Retrieval first returns a larger set of candidates as (id, distance, tokens)
+without their text. `choose` drops candidates farther than `max_distance`
+and picks the closest ones whose stored token counts (the `tokens` column
+written by the loader) fit into `max_tokens`; only those rows' text is then
+fetched. `pack` counts the fetched texts with the chat model's tokenizer and
+trims the last chunk to an excerpt if it would overflow the budget.
+"""
+import tiktoken
+
+# Chat model the API prompts; the loader counts the `tokens` column with its
+# tokenizer so that `choose` budgets in the same tokens as `pack`
+CHAT_MODEL = "gpt-4o-mini"
+
+
+def chat_encoding(model=CHAT_MODEL):
+    """tiktoken encoding of the chat model (o200k_base for the gpt-4o family)."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+class ContextBuilder:
+
+    def __init__(self, encoding, max_tokens=2000, max_distance=None, min_excerpt_tokens=64,
+                 prefill_ms_per_1k=25.0):
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+        self.max_distance = max_distance
+        self.min_excerpt_tokens = min_excerpt_tokens
+        # Only used to estimate the completion time saved by smaller prompts
+        self.prefill_ms_per_1k = prefill_ms_per_1k
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def choose(self, candidates, max_chunks):
+        """(chosen [(id, distance)], stats) from candidates [(id, distance, tokens)], closest first.
+
+        tokens may be None for rows loaded before the column existed; those
+        are chosen and measured once fetched.
+        """
+        chosen, budget, dropped = [], self.max_tokens, 0
+        for id_, distance, tokens in candidates:
+            if self.max_distance is not None and distance > self.max_distance:
+                dropped += 1
+                continue
+            if len(chosen) >= max_chunks or budget < self.min_excerpt_tokens:
+                break
+            # A chunk bigger than what is left is trimmed to an excerpt by pack()
+            chosen.append((id_, distance))
+            budget -= min(tokens or 0, budget)
+        # What the prompt would have held without the builder: the top max_chunks, whole
+        top = [tokens for _, _, tokens in candidates[:max_chunks]]
+        baseline = sum(top) if None not in top else None
+        return chosen, {"candidates": len(candidates), "dropped_by_distance": dropped,
+                        "baseline_tokens": baseline}
+
+    def pack(self, rows, stats=None):
+        """(texts, rows, stats) for rows in retrieval order, fitted into max_tokens."""
+        stats = dict(stats or {})
+        texts, used, budget, trimmed = [], [], self.max_tokens, 0
+        for row in rows:
+            ids = self.encoding.encode(row[1], disallowed_special=())
+            if len(ids) <= budget:
+                texts.append(row[1])
+            elif budget >= self.min_excerpt_tokens:
+                texts.append(self.encoding.decode(ids[:budget]))
+                trimmed += 1
+            else:
+                continue
+            used.append(row)
+            budget -= min(len(ids), budget)
+        context_tokens = self.max_tokens - budget
+        stats.update(chunks=len(used), trimmed=trimmed, context_tokens=context_tokens)
+        baseline = stats.get("baseline_tokens")
+        if baseline is not None:
+            saved = max(baseline - context_tokens, 0)
+            stats.update(tokens_saved=saved,
+                         estimated_ms_saved=round(saved * self.prefill_ms_per_1k / 1000, 1))
+        return texts, used, stats
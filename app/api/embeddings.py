@@ -0,0 +1,257 @@
+# coding: utf-8
+"""Embedding backends shared by the API server and the loader.
+
+Every backend has a `name` (used in cache keys), `dimensions` (the VECTOR
+size of the embeddings table), `max_input_tokens` (the longest input the
+model reads in full, in its own tokens), a blocking `embed_sync(texts)` for the
+loader and an `async embed(texts)` for the API; both return an (n, d)
+float32 array.
+
+- OpenAIBackend calls the embeddings API.
+- LocalBackend runs a SentenceTransformer model, or an ONNX export of one,
+  on CPU, with inference on a dedicated thread.
+
+In both, concurrent `embed` calls are merged by a MicroBatcher into one API
+request or forward pass; `embed_batch` sends a batch the caller already
+collected as a single request, bypassing it.
+
+Heavy libraries (torch, onnxruntime) are only imported when a local backend
+is created.
+"""
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+OPENAI_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+OPENAI_MAX_INPUT_TOKENS = 8191  # per-input limit of the OpenAI embedding models
+
+
+class MicroBatcher:
+    """Merges concurrent single-text requests into batched calls.
+
+    Texts submitted within `max_wait` seconds of each other (up to
+    `max_batch`) are passed to `embed_many` together and each caller gets
+    its own row back. Identical texts in a batch are only embedded once.
+    """
+
+    def __init__(self, embed_many, max_batch=64, max_wait=0.005):
+        self.embed_many = embed_many
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        # the loop only holds weak references to tasks
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+        self.duplicates = 0
+
+    async def submit(self, text):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            task = asyncio.ensure_future(self._run(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending):
+        texts = list(dict.fromkeys(text for text, _ in pending))
+        self.batches += 1
+        self.items += len(pending)
+        self.duplicates += len(pending) - len(texts)
+        try:
+            vectors = await self.embed_many(texts)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        rows = dict(zip(texts, vectors))
+        for text, future in pending:
+            if not future.done():
+                future.set_result(rows[text])
+
+    def stats(self):
+        return {"batches": self.batches, "items": self.items, "duplicates": self.duplicates}
+
+
+class OpenAIBackend:
+    """OpenAI embeddings API; async calls from concurrent requests share one API request.
+
+    max_batch=1 sends every `embed` call as its own request.
+    """
+
+    def __init__(self, model="text-embedding-ada-002", dimensions=None, client=None, async_client=None,
+                 max_batch=64, max_wait=0.005):
+        self.model = model
+        self.name = f"openai:{model}" + (f":{dimensions}" if dimensions else "")
+        # text-embedding-3 models can be shortened with the dimensions parameter
+        self.request_dimensions = dimensions
+        self.dimensions = dimensions or OPENAI_DIMENSIONS.get(model, 1536)
+        self.max_input_tokens = OPENAI_MAX_INPUT_TOKENS
+        self.client = client
+        self.async_client = async_client
+        self.batcher = MicroBatcher(self._embed_many, max_batch=max_batch, max_wait=max_wait)
+        self.api_calls = 0
+
+    def _kwargs(self, texts):
+        kwargs = {"input": list(texts), "model": self.model}
+        if self.request_dimensions:
+            kwargs["dimensions"] = self.request_dimensions
+        return kwargs
+
+    @staticmethod
+    def _to_array(response):
+        data = sorted(response.data, key=lambda d: d.index)
+        return np.array([d.embedding for d in data], dtype=np.float32)
+
+    def embed_sync(self, texts):
+        return self._to_array(self.client.embeddings.create(**self._kwargs(texts)))
+
+    async def _embed_many(self, texts):
+        self.api_calls += 1
+        return self._to_array(await self.async_client.embeddings.create(**self._kwargs(texts)))
+
+    async def embed(self, texts):
+        if self.batcher.max_batch <= 1:
+            return await self._embed_many(texts)
+        vectors = await asyncio.gather(*(self.batcher.submit(text) for text in texts))
+        return np.stack(vectors)
+
+    async def embed_batch(self, texts):
+        return await self._embed_many(list(texts))
+
+    def stats(self):
+        return {"backend": self.name, "api_calls": self.api_calls, **self.batcher.stats()}
+
+
+class LocalBackend:
+    """CPU embedding with SentenceTransformer, or onnxruntime when onnx_path is set.
+
+    onnx_path is a directory holding model.onnx and tokenizer.json, e.g. an
+    ONNX export of all-MiniLM-L6-v2. threads bounds the intra-op threads of
+    the inference runtime. Input past max_input_tokens word pieces (the
+    model's max_seq_length, 256 for MiniLM) is cut off before embedding.
+    """
+
+    def __init__(self, model="all-MiniLM-L6-v2", onnx_path=None, threads=None,
+                 max_batch=64, max_wait=0.005):
+        self.model_name = model
+        self.name = f"local:{model}"
+        if onnx_path:
+            self._encode = self._load_onnx(onnx_path, threads)
+        else:
+            self._encode = self._load_sentence_transformer(model, threads)
+        self.dimensions = int(self._encode(["dimension probe"]).shape[1])
+        # a single worker keeps batches from competing for the same cores
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+        self.batcher = MicroBatcher(self._embed_many, max_batch=max_batch, max_wait=max_wait)
+
+    def _load_sentence_transformer(self, model, threads):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            torch.set_num_threads(threads)
+        st = SentenceTransformer(model, device="cpu")
+        self.max_input_tokens = st.max_seq_length
+
+        def encode(texts):
+            return st.encode(list(texts), batch_size=len(texts), normalize_embeddings=True,
+                             convert_to_numpy=True).astype(np.float32)
+        return encode
+
+    def _load_onnx(self, path, threads):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        session = onnxruntime.InferenceSession(os.path.join(path, "model.onnx"), options,
+                                               providers=["CPUExecutionProvider"])
+        tokenizer = Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+        tokenizer.enable_padding()
+        # sentence-transformers exports carry the model's max_seq_length next to it
+        self.max_input_tokens = 256
+        config = os.path.join(path, "sentence_bert_config.json")
+        if os.path.exists(config):
+            with open(config) as f:
+                self.max_input_tokens = json.load(f).get("max_seq_length", 256)
+        tokenizer.enable_truncation(max_length=self.max_input_tokens)
+        input_names = {i.name for i in session.get_inputs()}
+
+        def encode(texts):
+            encoded = tokenizer.encode_batch(list(texts))
+            feed = {"input_ids": np.array([e.ids for e in encoded], dtype=np.int64),
+                    "attention_mask": np.array([e.attention_mask for e in encoded], dtype=np.int64)}
+            if "token_type_ids" in input_names:
+                feed["token_type_ids"] = np.array([e.type_ids for e in encoded], dtype=np.int64)
+            hidden = session.run(None, feed)[0]
+            # mean pooling over real tokens, then L2 normalize like SentenceTransformer
+            mask = feed["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            return (pooled / np.linalg.norm(pooled, axis=1, keepdims=True)).astype(np.float32)
+        return encode
+
+    def embed_sync(self, texts):
+        return self._encode(list(texts))
+
+    async def _embed_many(self, texts):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, texts)
+
+    async def embed(self, texts):
+        vectors = await asyncio.gather(*(self.batcher.submit(text) for text in texts))
+        return np.stack(vectors)
+
+    async def embed_batch(self, texts):
+        return await self._embed_many(list(texts))
+
+    def stats(self):
+        return {"backend": self.name, **self.batcher.stats()}
+
+
+def create_backend(kind="openai", model=None, dimensions=None, client=None, async_client=None,
+                   onnx_path=None, threads=None, max_batch=64, max_wait=0.005):
+    if kind == "openai":
+        return OpenAIBackend(model or "text-embedding-ada-002", dimensions=dimensions,
+                             client=client, async_client=async_client,
+                             max_batch=max_batch, max_wait=max_wait)
+    if kind == "local":
+        return LocalBackend(model or "all-MiniLM-L6-v2", onnx_path=onnx_path, threads=threads,
+                            max_batch=max_batch, max_wait=max_wait)
+    raise ValueError(f"unknown embedding backend: {kind}")
+
+
+def backend_from_env(client=None, async_client=None):
+    """Backend selected by EMBEDDING_BACKEND / EMBEDDING_MODEL and friends."""
+    dimensions = os.environ.get("EMBEDDING_DIMENSIONS")
+    threads = os.environ.get("LOCAL_EMBEDDING_THREADS")
+    return create_backend(os.environ.get("EMBEDDING_BACKEND", "openai"),
+                          model=os.environ.get("EMBEDDING_MODEL"),
+                          dimensions=int(dimensions) if dimensions else None,
+                          client=client, async_client=async_client,
+                          onnx_path=os.environ.get("LOCAL_EMBEDDING_ONNX_PATH"),
+                          threads=int(threads) if threads else None,
+                          max_batch=int(os.environ.get("EMBED_BATCH_MAX", "64")),
+                          max_wait=float(os.environ.get("EMBED_BATCH_WAIT_MS", "5")) / 1000)
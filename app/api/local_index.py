@@ -0,0 +1,391 @@
+# coding: utf-8
+"""In-process vector search over a memory-mapped copy of the embeddings table.
+
+Each version of the `embeddings` table is written to LOCAL_INDEX_PATH as
+.npy files (vectors as float16 or float32, their squared norms, and ids)
+that every worker maps read-only, so all uvicorn workers on the host share
+one copy of the pages. Top-k is an exact L2 scan (one matmul per block plus
+argpartition); with `nlist` set, larger versions get an IVF coarse index
+(k-means centroids, rows stored grouped by list) and only the `nprobe`
+nearest lists are scanned.
+
+With dtype "int8" (per-dimension scaled) or "binary" (sign bits, Hamming
+distance) the scan reads quantized codes instead, 4x / 32x smaller than
+float32, and the best `rerank` * k candidates are reranked against the
+float32 vectors, of which only those rows are paged in.
+
+The loader bumps a row in `embedding_versions` whenever it writes a version.
+Workers poll that table; when a version changed, one worker (holding a file
+lock) fetches the rows changed since the last sync at a fixed
+AS OF SYSTEM TIME, drops deleted ids, and writes a new generation of files,
+which the other workers pick up on their next poll. A version whose copy is
+behind its marker, or that hasn't been confirmed current for
+`max_staleness` seconds, is not served and callers fall back to SQL.
+"""
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from decimal import Decimal
+
+import numpy as np
+from psycopg import sql
+
+logger = logging.getLogger(__name__)
+
+_ZERO_ID = uuid.UUID(int=0)
+_BLOCK_ROWS = 4096
+
+
+def _file_prefix(directory, version):
+    return os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", version))
+
+
+def _nearest_centroid(vectors, centroids):
+    c_norms = (centroids ** 2).sum(axis=1)
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + _BLOCK_ROWS], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmin(c_norms - 2 * block @ centroids.T, axis=1)
+    return assign
+
+
+def kmeans(vectors, nlist, iterations=10, sample_per_list=256, seed=0):
+    """Centroids of nlist clusters, trained on a sample of vectors."""
+    rng = np.random.default_rng(seed)
+    n = min(len(vectors), nlist * sample_per_list)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), n, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(n, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest_centroid(sample, centroids)
+        counts = np.bincount(assign, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Restart empty lists on random points
+        centroids[empty] = sample[rng.choice(n, int(empty.sum()), replace=False)]
+    return centroids
+
+
+QUANTIZED = ("int8", "binary")
+
+
+def quantize(vectors, kind):
+    """(codes, per-dimension scales) of float32 vectors; binary codes have no scales."""
+    if kind == "binary":
+        return np.packbits(vectors > 0, axis=1), None
+    scales = np.abs(vectors).max(axis=0) / 127 if len(vectors) else np.ones(vectors.shape[1], np.float32)
+    scales = np.where(scales > 0, scales, 1).astype(np.float32)
+    return np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8), scales
+
+
+def write_generation(directory, version, generation, ids, vectors, synced_at,
+                     dtype="float16", centroids=None, trained_rows=0):
+    """Write one generation of a version's files and point its meta file at it.
+
+    ids is an array of 16-byte UUIDs (dtype S16). Returns the meta dict.
+    """
+    prefix = _file_prefix(directory, version)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    offsets = None
+    if centroids is not None:
+        assign = _nearest_centroid(vectors, centroids)
+        order = np.argsort(assign, kind="stable")
+        vectors, ids = vectors[order], ids[order]
+        offsets = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+    base = f"{prefix}.{generation}"
+    if dtype in QUANTIZED:
+        # Full-precision vectors are kept for the rerank
+        stored = vectors
+        codes, scales = quantize(vectors, dtype)
+        np.save(base + ".codes.npy", codes)
+        if scales is not None:
+            np.save(base + ".scales.npy", scales)
+        restored = codes.astype(np.float32) * scales if scales is not None else vectors
+    else:
+        stored = vectors.astype(dtype)
+        restored = stored.astype(np.float32)
+    # Norms of the stored (possibly rounded) vectors keep distances consistent
+    norms = np.einsum("ij,ij->i", restored, restored)
+
+    np.save(base + ".vectors.npy", stored)
+    np.save(base + ".norms.npy", norms)
+    np.save(base + ".ids.npy", np.asarray(ids, dtype="S16"))
+    if centroids is not None:
+        np.savez(base + ".ivf.npz", centroids=centroids, offsets=offsets)
+
+    meta = {"version": version, "generation": generation, "rows": len(stored),
+            "dimensions": int(stored.shape[1]) if stored.ndim == 2 else 0,
+            "dtype": dtype if dtype in QUANTIZED else str(np.dtype(dtype)), "synced_at": str(synced_at),
+            "ivf": centroids is not None, "trained_rows": trained_rows}
+    tmp = f"{prefix}.meta.json.tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, prefix + ".meta.json")
+
+    # Workers still mapping an older generation keep their pages after unlink
+    for path in glob.glob(glob.escape(prefix) + ".*.*.np[yz]"):
+        parts = path[len(prefix) + 1:].split(".")
+        if len(parts) == 3 and parts[0].isdigit() and int(parts[0]) < generation - 1:
+            os.remove(path)
+    return meta
+
+
+def read_meta(directory, version):
+    try:
+        with open(_file_prefix(directory, version) + ".meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class VersionIndex:
+    """Read-only, memory-mapped generation of one version."""
+
+    def __init__(self, directory, meta):
+        self.meta = meta
+        base = f"{_file_prefix(directory, meta['version'])}.{meta['generation']}"
+        self.vectors = np.load(base + ".vectors.npy", mmap_mode="r")
+        self.norms = np.load(base + ".norms.npy", mmap_mode="r")
+        self.ids = np.load(base + ".ids.npy", mmap_mode="r")
+        self.quantized = meta["dtype"] if meta["dtype"] in QUANTIZED else None
+        self.codes = self.scales = None
+        if self.quantized:
+            self.codes = np.load(base + ".codes.npy", mmap_mode="r")
+            if self.quantized == "int8":
+                self.scales = np.load(base + ".scales.npy")
+        self.centroids = self.offsets = None
+        if meta["ivf"]:
+            with np.load(base + ".ivf.npz") as ivf:
+                self.centroids, self.offsets = ivf["centroids"], ivf["offsets"]
+
+    def _ranges(self, query, nprobe):
+        if self.centroids is None:
+            return [(0, len(self.vectors))]
+        distances = ((self.centroids - query) ** 2).sum(axis=1)
+        nprobe = min(nprobe, len(distances))
+        probe = np.argpartition(distances, nprobe - 1)[:nprobe]
+        return [(self.offsets[c], self.offsets[c + 1]) for c in probe]
+
+    def _scores(self, query, s, e):
+        """Distance-like scores of rows s:e, smaller is closer."""
+        if self.quantized == "binary":
+            bits = np.packbits(query > 0)
+            return np.bitwise_count(self.codes[s:e] ^ bits).sum(axis=1, dtype=np.int32)
+        if self.quantized == "int8":
+            # (codes * scales) . q == codes . (scales * q)
+            dots = np.asarray(self.codes[s:e], dtype=np.float32) @ (self.scales * query)
+        else:
+            dots = np.asarray(self.vectors[s:e], dtype=np.float32) @ query
+        return self.norms[s:e] - 2 * dots + float(query @ query)
+
+    def search(self, query, k, nprobe=8, rerank=10):
+        """[(row, L2 distance)] of the k nearest rows, closest first."""
+        query = np.asarray(query, dtype=np.float32)
+        n = k * rerank if self.quantized else k
+        rows, scores = [], []
+        for start, stop in self._ranges(query, nprobe):
+            for s in range(start, stop, _BLOCK_ROWS):
+                e = min(stop, s + _BLOCK_ROWS)
+                d = self._scores(query, s, e)
+                if len(d) > n:
+                    top = np.argpartition(d, n - 1)[:n]
+                    d = d[top]
+                else:
+                    top = np.arange(len(d))
+                rows.append(top + s)
+                scores.append(d)
+        if not rows:
+            return []
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        if self.quantized:
+            # Rerank the best candidates against the full-precision vectors
+            candidates = np.sort(rows[np.argsort(scores, kind="stable")[:n]])
+            rows = candidates
+            scores = np.linalg.norm(np.asarray(self.vectors[candidates]) - query, axis=1) ** 2
+        order = np.argsort(scores)[:k]
+        return [(int(rows[i]), float(np.sqrt(max(scores[i], 0.0)))) for i in order]
+
+    def id(self, row):
+        # Indexing an S16 array strips trailing NUL bytes, so slice instead
+        return uuid.UUID(bytes=self.ids[row:row + 1].tobytes())
+
+
+class LocalIndex:
+    """Memory-mapped search tier for every version in embedding_versions."""
+
+    def __init__(self, directory, dtype="float32", nlist=0, nprobe=8, rerank=10, refresh_interval=10,
+                 max_staleness=60, page_size=2000):
+        self.directory = directory
+        self.dtype = dtype
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.page_size = page_size
+        self._versions = {}     # version -> VersionIndex
+        self._markers = {}      # version -> Decimal MVCC timestamp of its marker row
+        self._confirmed_at = {}  # version -> monotonic time the copy was last known current
+        self.searches = 0
+        self.fallbacks = 0
+        self.refreshes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def fresh(self, version):
+        index = self._versions.get(version)
+        if index is None or version not in self._markers:
+            return False
+        if Decimal(index.meta["synced_at"]) < self._markers[version]:
+            return False
+        return time.monotonic() - self._confirmed_at.get(version, 0) <= self.max_staleness
+
+    def search(self, version, embedding, k):
+        """[(id, distance)] of the k nearest chunks, or None when the copy can't be trusted."""
+        if not self.fresh(version):
+            self.fallbacks += 1
+            return None
+        self.searches += 1
+        index = self._versions[version]
+        return [(index.id(row), distance) for row, distance in index.search(embedding, k, self.nprobe, self.rerank)]
+
+    def _load(self, version):
+        meta = read_meta(self.directory, version)
+        current = self._versions.get(version)
+        if meta is None or (current is not None and current.meta["generation"] == meta["generation"]):
+            return
+        self._versions[version] = VersionIndex(self.directory, meta)
+        logger.info("local index %s: generation %d, %d rows", version, meta["generation"], meta["rows"])
+
+    async def _fetch(self, conn, query, params):
+        """All rows of a keyset-paginated query; the last column of each row is the id."""
+        rows, last = [], _ZERO_ID
+        while True:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, {**params, "after": last, "limit": self.page_size})
+                page = await cursor.fetchall()
+            rows += page
+            if len(page) < self.page_size:
+                return rows
+            last = page[-1][-1]
+
+    async def _sync(self, conn, version, meta):
+        """Bring the on-disk copy of version up to date; runs under the version's file lock."""
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT cluster_logical_timestamp()")
+            read_at = (await cursor.fetchone())[0]
+        as_of = sql.SQL("AS OF SYSTEM TIME {}").format(sql.Literal(str(read_at)))
+        since = Decimal(meta["synced_at"]) if meta is not None else Decimal(0)
+        changed = await self._fetch(conn, sql.SQL(
+            "SELECT embedding, id FROM embeddings {} WHERE version = %(version)s "
+            "AND crdb_internal_mvcc_timestamp > %(since)s AND id > %(after)s "
+            "ORDER BY id LIMIT %(limit)s").format(as_of),
+            {"version": version, "since": since})
+        new_ids = np.array([row[1].bytes for row in changed], dtype="S16")
+        new_vectors = np.array([row[0] for row in changed], dtype=np.float32)
+
+        centroids, trained_rows = None, 0
+        if meta is None:
+            ids, vectors = new_ids, new_vectors
+        else:
+            live = await self._fetch(conn, sql.SQL(
+                "SELECT id FROM embeddings {} WHERE version = %(version)s AND id > %(after)s "
+                "ORDER BY id LIMIT %(limit)s").format(as_of), {"version": version})
+            old = VersionIndex(self.directory, meta)
+            keep = np.isin(old.ids, np.array([row[0].bytes for row in live], dtype="S16"))
+            if len(new_ids):
+                keep &= ~np.isin(old.ids, new_ids)
+            ids = np.concatenate([np.asarray(old.ids[keep]), new_ids])
+            # An empty generation is stored with shape (0, 0), so only non-empty parts are stacked
+            parts = [np.asarray(old.vectors[keep], dtype=np.float32), new_vectors]
+            parts = [part for part in parts if len(part)]
+            vectors = np.concatenate(parts) if parts else new_vectors
+            if old.centroids is not None:
+                centroids, trained_rows = old.centroids, meta["trained_rows"]
+        if len(ids) == 0:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+
+        # (Re)train the coarse index once a version is big enough, or has doubled
+        if self.nlist and len(ids) >= 40 * self.nlist and (centroids is None or len(ids) > 2 * trained_rows):
+            centroids = await asyncio.to_thread(kmeans, vectors, self.nlist)
+            trained_rows = len(ids)
+        elif len(ids) < 40 * self.nlist:
+            centroids = None
+
+        generation = meta["generation"] + 1 if meta is not None else 1
+        await asyncio.to_thread(write_generation, self.directory, version, generation, ids, vectors,
+                                read_at, self.dtype, centroids, trained_rows)
+        self.refreshes += 1
+        logger.info("local index %s: synced %d changed rows, %d rows total",
+                    version, len(changed), len(ids))
+
+    async def refresh(self, conn):
+        # AS OF SYSTEM TIME reads have to be top-level statements
+        autocommit = conn.autocommit
+        await conn.set_autocommit(True)
+        try:
+            await self._refresh(conn)
+        finally:
+            await conn.set_autocommit(autocommit)
+
+    async def _refresh(self, conn):
+        async with conn.cursor() as cursor:
+            await cursor.execute("SELECT version, crdb_internal_mvcc_timestamp FROM embedding_versions")
+            markers = {row[0]: row[1] for row in await cursor.fetchall()}
+        for version, marker in markers.items():
+            self._markers[version] = marker
+            meta = read_meta(self.directory, version)
+            if meta is None or Decimal(meta["synced_at"]) < marker:
+                # One worker rebuilds; the others pick up its files on a later poll
+                with open(_file_prefix(self.directory, version) + ".lock", "w") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    meta = read_meta(self.directory, version)
+                    if meta is None or Decimal(meta["synced_at"]) < marker:
+                        await self._sync(conn, version, meta)
+            await asyncio.to_thread(self._load, version)
+            index = self._versions.get(version)
+            if index is not None and Decimal(index.meta["synced_at"]) >= marker:
+                self._confirmed_at[version] = time.monotonic()
+
+    async def run(self, pool):
+        """Background loop that keeps the local copies current."""
+        while True:
+            try:
+                async with pool.connection() as conn:
+                    await self.refresh(conn)
+            except Exception as e:
+                logger.warning("local index refresh failed: %s", e)
+            await asyncio.sleep(self.refresh_interval)
+
+    def stats(self):
+        now = time.monotonic()
+        return {"searches": self.searches, "fallbacks": self.fallbacks, "refreshes": self.refreshes,
+                "versions": {v: {"rows": index.meta["rows"], "generation": index.meta["generation"],
+                                 "dtype": index.meta["dtype"],
+                                 "ivf": index.meta["ivf"], "fresh": self.fresh(v),
+                                 "confirmed_age": round(now - self._confirmed_at[v], 1)
+                                 if v in self._confirmed_at else None}
+                             for v, index in self._versions.items()}}
+
+
+def local_index_from_env():
+    """LocalIndex when LOCAL_INDEX_PATH is set, else None."""
+    path = os.environ.get("LOCAL_INDEX_PATH")
+    if not path:
+        return None
+    return LocalIndex(path,
+                      dtype=os.environ.get("LOCAL_INDEX_DTYPE", "float32"),
+                      nlist=int(os.environ.get("LOCAL_INDEX_NLIST", "0")),
+                      nprobe=int(os.environ.get("LOCAL_INDEX_NPROBE", "8")),
+                      rerank=int(os.environ.get("LOCAL_INDEX_RERANK", "10")),
+                      refresh_interval=float(os.environ.get("LOCAL_INDEX_REFRESH_INTERVAL", "10")),
+                      max_staleness=float(os.environ.get("LOCAL_INDEX_MAX_STALENESS", "60")))
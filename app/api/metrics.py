@@ -0,0 +1,133 @@
+# coding: utf-8
+"""Per-stage latency, token and pool metrics of the API.
+
+`timed(stage)` observes a stage's duration in the `rag_stage_seconds`
+histogram and adds it to the current request's timings, which
+ServerTimingMiddleware sends back as a `Server-Timing` header:
+
+    server-timing: key;dur=0.1, pool_wait;dur=0.3, embed;dur=81.2, search;dur=12.5, total;dur=...
+
+Stages that run after the response headers are sent (the completion of a
+streamed answer) only reach the histograms. Pool figures are read from
+`get_stats()` when /metrics is scraped, so they cost nothing per request.
+Metrics are per worker process.
+"""
+import contextlib
+import contextvars
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+STAGES = ("key", "pool_wait", "db_queue", "llm_queue", "embed", "search", "llm", "coalesced", "total")
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Duration of each stage of a RAG request", ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+TOKENS = Counter("rag_tokens", "Tokens sent to and received from the chat model", ["kind"])
+CONTEXT_TOKENS = Histogram(
+    "rag_context_tokens", "Retrieved context tokens per prompt",
+    buckets=(0, 250, 500, 1000, 1500, 2000, 3000, 4000, 8000))
+
+# Label children are bound once; observe() on them is a lock and two adds
+_stage = {stage: STAGE_SECONDS.labels(stage) for stage in STAGES}
+_tokens = {kind: TOKENS.labels(kind) for kind in ("prompt", "completion")}
+
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def record(stage, seconds):
+    _stage[stage].observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def record_usage(usage, context_tokens=None):
+    """Token counts of a completion (its `usage`, may be None) and of its retrieved context."""
+    if usage is not None:
+        _tokens["prompt"].inc(usage.prompt_tokens or 0)
+        _tokens["completion"].inc(usage.completion_tokens or 0)
+    if context_tokens is not None:
+        CONTEXT_TOKENS.observe(context_tokens)
+
+
+def server_timing(timings):
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware collecting the stage timings of requests under `paths`.
+
+    The whole request, streamed body included, is observed as "total".
+    """
+
+    def __init__(self, app, paths=("/rag",)):
+        self.app = app
+        self.paths = tuple(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.paths):
+            return await self.app(scope, receive, send)
+        timings = {}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                timings["total"] = time.perf_counter() - start
+                # timing-allow-origin lets the cross-origin frontend read it too
+                message = {**message, "headers": [*message.get("headers", []),
+                                                  (b"server-timing", server_timing(timings).encode()),
+                                                  (b"timing-allow-origin", b"*")]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _stage["total"].observe(time.perf_counter() - start)
+            _timings.reset(token)
+
+
+class PoolCollector:
+    """Size, idle connections, waiting requests and wait time of connection pools."""
+
+    def __init__(self, pools):
+        self.pools = pools  # callable returning {name: AsyncConnectionPool}
+
+    def collect(self):
+        size = GaugeMetricFamily("rag_pool_size", "Open connections", labels=["pool"])
+        max_size = GaugeMetricFamily("rag_pool_max_size", "Maximum connections", labels=["pool"])
+        available = GaugeMetricFamily("rag_pool_available", "Idle connections", labels=["pool"])
+        waiting = GaugeMetricFamily("rag_pool_requests_waiting", "Requests waiting for a connection",
+                                    labels=["pool"])
+        requests = CounterMetricFamily("rag_pool_requests", "Connection requests", labels=["pool"])
+        wait = CounterMetricFamily("rag_pool_wait_seconds", "Time spent waiting for a connection",
+                                   labels=["pool"])
+        for name, pool in self.pools().items():
+            stats = pool.get_stats()
+            size.add_metric([name], stats.get("pool_size", 0))
+            max_size.add_metric([name], stats.get("pool_max", 0))
+            available.add_metric([name], stats.get("pool_available", 0))
+            waiting.add_metric([name], stats.get("requests_waiting", 0))
+            requests.add_metric([name], stats.get("requests_num", 0))
+            wait.add_metric([name], stats.get("requests_wait_ms", 0) / 1000)
+        return [size, max_size, available, waiting, requests, wait]
+
+
+def register_pools(pools):
+    REGISTRY.register(PoolCollector(pools))
+
+
+def render():
+    """(body, content type) of the /metrics response."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,163 @@
+# coding: utf-8
+"""Read routing across the nodes of a multi-node cluster.
+
+A ReadRouter keeps one autocommit AsyncConnectionPool per node (autocommit
+so retrieval can use AS OF SYSTEM TIME follower reads) and sends each read
+to the best healthy node:
+
+- "nearest": lowest health-check round trip (an EWMA of `SELECT 1`);
+- "least_loaded": lowest (in-flight reads + 1) x EWMA of read latency.
+
+A background task pings every node; a node that fails a ping or a read is
+skipped until a ping succeeds again, and a read that fails on one node with
+a connection error is retried on the next. Query errors (statement timeout,
+transaction retry, a pool out of connections) of a busy node are raised
+as is and don't mark it down.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+from urllib.parse import urlsplit
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("nearest", "least_loaded")
+
+
+class NodePool:
+
+    def __init__(self, url, configure=None, min_size=1, max_size=10, timeout=2.0, alpha=0.2):
+        parts = urlsplit(url)
+        self.name = f"{parts.hostname}:{parts.port or 26257}"
+        self.pool = AsyncConnectionPool(conninfo=url,
+                                        kwargs={"application_name": "chatbot-read", "autocommit": True},
+                                        min_size=min_size, max_size=max_size, max_lifetime=600,
+                                        timeout=timeout, configure=configure, open=False)
+        self.alpha = alpha
+        self.healthy = True
+        self.in_flight = 0
+        self.rtt = None        # EWMA seconds of SELECT 1
+        self.latency = None    # EWMA seconds of reads
+        self.reads = 0
+        self.errors = 0
+        self.last_error = None
+
+    def _ewma(self, current, sample):
+        return sample if current is None else (1 - self.alpha) * current + self.alpha * sample
+
+    def score(self, policy):
+        if policy == "nearest":
+            return self.rtt if self.rtt is not None else float("inf")
+        return (self.in_flight + 1) * (self.latency or self.rtt or 0.001)
+
+    def failed(self, error):
+        self.healthy = False
+        self.errors += 1
+        self.last_error = str(error)
+        logger.warning("read node %s marked down: %s", self.name, error)
+
+    def stats(self):
+        ms = lambda s: None if s is None else round(s * 1000, 2)  # noqa: E731
+        return {"healthy": self.healthy, "in_flight": self.in_flight, "rtt_ms": ms(self.rtt),
+                "latency_ms": ms(self.latency), "reads": self.reads, "errors": self.errors,
+                "last_error": self.last_error, "pool": self.pool.get_stats()}
+
+
+def is_connection_error(error, conn=None):
+    """True if error means the connection to the node failed, not the query on it."""
+    if conn is not None and (conn.broken or conn.closed):
+        return True
+    if isinstance(error, PoolTimeout):
+        return False
+    if isinstance(error, psycopg.errors.ConnectionException):  # SQLSTATE class 08
+        return True
+    # Errors reported by the server carry a SQLSTATE; a lost connection has none
+    return isinstance(error, psycopg.OperationalError) and error.sqlstate is None
+
+
+class ReadRouter:
+
+    def __init__(self, urls, configure=None, policy="least_loaded", min_size=1, max_size=10,
+                 timeout=2.0, health_interval=5.0, max_attempts=2):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown read routing policy: {policy}")
+        self.nodes = [NodePool(url, configure, min_size, max_size, timeout) for url in urls]
+        self.policy = policy
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.max_attempts = max_attempts
+        self.failovers = 0
+
+    async def open(self):
+        # Don't wait: a node that is down at startup is picked up by the health checks
+        for node in self.nodes:
+            await node.pool.open(wait=False)
+
+    async def close(self):
+        for node in self.nodes:
+            await node.pool.close()
+
+    def ranked(self):
+        """Nodes best first; unhealthy nodes come last, in case every node is marked down."""
+        return sorted(self.nodes, key=lambda n: (not n.healthy, n.score(self.policy)))
+
+    @contextlib.asynccontextmanager
+    async def connection(self, node):
+        start = time.perf_counter()
+        node.in_flight += 1
+        conn = None
+        try:
+            async with node.pool.connection() as conn:
+                yield conn
+        except Exception as e:
+            if is_connection_error(e, conn):
+                node.failed(e)
+            raise
+        else:
+            node.reads += 1
+            node.latency = node._ewma(node.latency, time.perf_counter() - start)
+        finally:
+            node.in_flight -= 1
+
+    async def run(self, fn):
+        """await fn(conn) on the best node, failing over to the next on connection errors."""
+        error = None
+        for attempt, node in enumerate(self.ranked()[:self.max_attempts]):
+            if attempt:
+                self.failovers += 1
+            conn = None
+            try:
+                async with self.connection(node) as conn:
+                    return await fn(conn)
+            except Exception as e:
+                if not is_connection_error(e, conn):
+                    raise
+                error = e
+        raise error
+
+    async def check(self, node):
+        start = time.perf_counter()
+        try:
+            async with node.pool.connection(timeout=self.timeout) as conn:
+                await conn.execute("SELECT 1")
+        except Exception as e:
+            if node.healthy:
+                node.failed(e)
+            return
+        node.rtt = node._ewma(node.rtt, time.perf_counter() - start)
+        if not node.healthy:
+            logger.info("read node %s is back", node.name)
+        node.healthy = True
+
+    async def run_health_checks(self):
+        while True:
+            await asyncio.gather(*(self.check(node) for node in self.nodes))
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self):
+        return {"policy": self.policy, "failovers": self.failovers,
+                "nodes": {node.name: node.stats() for node in self.nodes}}
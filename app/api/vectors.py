@@ -0,0 +1,118 @@
+# coding: utf-8
+"""psycopg adapters that send and receive VECTOR values as numpy float32 arrays.
+
+Passing an np.ndarray as a query parameter uses the binary pgvector wire
+format (int16 dimensions, int16 unused, big-endian float32s) when the server
+accepts it, otherwise a compact text form with 9 significant digits, which
+round-trips float32 exactly. Vector columns are returned as np.float32 arrays.
+"""
+import logging
+import struct
+
+import numpy as np
+from psycopg.adapt import Dumper, Loader
+from psycopg.pq import Format
+from psycopg.types import TypeInfo
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct(">HH")
+
+
+def to_vector(embedding):
+    """Embedding as a contiguous np.float32 array."""
+    return np.ascontiguousarray(embedding, dtype=np.float32)
+
+
+def format_vector(vec):
+    """pgvector text literal, e.g. b'[0.5,1,-2.25]'."""
+    return ("[" + ",".join(["%.9g"] * len(vec)) % tuple(vec.tolist()) + "]").encode()
+
+
+class VectorTextDumper(Dumper):
+    # oid stays 0 (unknown) unless registered, so the server infers VECTOR from context
+    format = Format.TEXT
+
+    def dump(self, obj):
+        return format_vector(to_vector(obj))
+
+
+class VectorBinaryDumper(Dumper):
+    format = Format.BINARY
+
+    def dump(self, obj):
+        vec = to_vector(obj)
+        return _HEADER.pack(len(vec), 0) + vec.astype(">f4").tobytes()
+
+
+class VectorTextLoader(Loader):
+    format = Format.TEXT
+
+    def load(self, data):
+        text = bytes(data).decode()
+        return np.array(text.strip("[]").split(","), dtype=np.float32)
+
+
+class VectorBinaryLoader(Loader):
+    format = Format.BINARY
+
+    def load(self, data):
+        dim, _ = _HEADER.unpack_from(data)
+        return np.frombuffer(data, dtype=">f4", count=dim, offset=_HEADER.size).astype(np.float32)
+
+
+def register_vector(context, info=None, binary=False):
+    """Register the numpy <-> VECTOR adapters on a connection.
+
+    info is the TypeInfo of "vector" (see fetch_vector_info); without it
+    parameters go out as untyped text and the server infers the type. binary
+    selects the binary dumper, which needs info for the type oid.
+    """
+    adapters = context.adapters
+    if info is None:
+        adapters.register_dumper(np.ndarray, VectorTextDumper)
+        return
+    info.register(context)
+    # The last dumper registered for a class is the one %s placeholders use
+    adapters.register_dumper(np.ndarray, type("VectorTextDumper", (VectorTextDumper,), {"oid": info.oid}))
+    if binary:
+        adapters.register_dumper(np.ndarray, type("VectorBinaryDumper", (VectorBinaryDumper,), {"oid": info.oid}))
+    adapters.register_loader(info.oid, VectorTextLoader)
+    adapters.register_loader(info.oid, VectorBinaryLoader)
+
+
+def fetch_vector_info(conn):
+    """TypeInfo for "vector", or None (a coroutine on async connections)."""
+    return TypeInfo.fetch(conn, "vector")
+
+
+def probe_binary(conn, info):
+    """Whether the server accepts binary VECTOR parameters; registers the result on conn."""
+    register_vector(conn, info, binary=True)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT %b::VECTOR", (np.zeros(2, dtype=np.float32),))
+        supported = True
+    except Exception as e:
+        logger.info("binary VECTOR parameters not supported, using text: %s", e)
+        supported = False
+    conn.rollback()
+    if not supported:
+        register_vector(conn, info, binary=False)
+    return supported
+
+
+async def aprobe_binary(conn, info):
+    """Async variant of probe_binary."""
+    register_vector(conn, info, binary=True)
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT %b::VECTOR", (np.zeros(2, dtype=np.float32),))
+        supported = True
+    except Exception as e:
+        logger.info("binary VECTOR parameters not supported, using text: %s", e)
+        supported = False
+    await conn.rollback()
+    if not supported:
+        register_vector(conn, info, binary=False)
+    return supported
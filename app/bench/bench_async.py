@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Compare GET /rag on the old threadpool-bound sync handler with the async app.
+
+Both run in process with OpenAI pointed at fake_openai.py and the database
+at --database-url (seeded like bench_e2e.py), and get --requests concurrent
+/rag requests through httpx's ASGI transport at each --concurrency:
+
+- sync: the handler as it was before the async rewrite (sync_app below): a
+  plain `def` route on Starlette's threadpool (40 workers) with the blocking
+  OpenAI client and a psycopg ConnectionPool of the default 4 connections,
+  held for the whole request.
+- async: the FastAPI app of app/api, lifespan included.
+
+Each level prints both side by side with the speedup in wall time. A ticker
+task on the event loop also measures how late its 5ms sleeps wake up while
+the requests are in flight (loop_lag), and ideal_rps = concurrency / (embed +
+chat latency) is what a handler that never blocks could reach.
+
+    FAKE_EMBED_LATENCY_MS=200 FAKE_CHAT_LATENCY_MS=2000 python bench_async.py --requests 200 --concurrency 50 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from openai import OpenAI
+from psycopg_pool import ConnectionPool
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API = os.path.join(HERE, "..", "api")
+
+
+def start_fake_server(port):
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_openai.py"),
+                             "--port", str(port)])
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            httpx.post(f"http://127.0.0.1:{port}/v1/embeddings",
+                       json={"input": ["ping"], "model": "warmup"})
+            return proc
+        except httpx.TransportError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("fake OpenAI server did not start")
+
+
+def sync_app(database_url, base_url, version):
+    """(app, pool) serving /rag the way app/api did before it went async."""
+    client = OpenAI(api_key="fake", base_url=base_url)
+    pool = ConnectionPool(conninfo=database_url, kwargs={"application_name": "bench_async_sync"},
+                          open=False)
+    app = FastAPI()
+    bearer_scheme = HTTPBearer()
+
+    def verify_api_key(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
+        with pool.connection() as conn:
+            row = conn.execute("SELECT 1 FROM api_keys WHERE key = %s AND is_active = TRUE LIMIT 1",
+                               (credentials.credentials,)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=403, detail="Invalid API Key")
+
+    @app.get("/rag")
+    def query_rag(question: str, api_check: bool = Depends(verify_api_key)):
+        with pool.connection() as conn:
+            response = client.embeddings.create(input=[question], model="text-embedding-ada-002")
+            embedding = f"[{','.join(map(str, response.data[0].embedding))}]"
+            rows = conn.execute("""
+                SELECT url, text, embedding <-> %s AS distance, id
+                FROM embeddings
+                WHERE version = %s
+                ORDER BY embedding <-> %s
+                LIMIT 3;
+            """, (embedding, version, embedding)).fetchall()
+            context = "\n".join(row[1] for row in rows)
+            answer = client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": f"<context>\n{context}\n</context>\n"
+                                                      f"<question>\n{question}\n</question>"}],
+            ).choices[0].message.content
+        return {"answer": answer, "urls": [str(row[0]) for row in rows], "ids": [str(row[3]) for row in rows]}
+
+    return app, pool
+
+
+async def loop_lag(stop, lags, interval=0.005):
+    """Append how late (seconds) each sleep of interval wakes up until stop is set."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def drive(http, questions, concurrency, percentiles):
+    """Send every question to /rag with concurrency in flight; throughput, latency and loop lag."""
+    latencies, errors, lags = [], {}, []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(question):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await http.get("/rag", params={"question": question})
+            if response.status_code != 200:
+                errors[str(response.status_code)] = errors.get(str(response.status_code), 0) + 1
+                return
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(loop_lag(stop, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(one(q) for q in questions))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+    lag_ms = [lag * 1000 for lag in lags]
+    return {"concurrency": concurrency, "requests": len(questions), "ok": len(latencies),
+            "seconds": round(elapsed, 3), "rps": round(len(latencies) / elapsed, 1), "errors": errors,
+            "latency": percentiles(latencies) if latencies else None,
+            "loop_lag": {**percentiles(lag_ms), "max_ms": round(max(lag_ms), 2)} if lag_ms else None}
+
+
+def client_for(asgi_app, api_key):
+    # raise_app_exceptions=False: a failing handler (e.g. a pool timeout) counts as a 500
+    transport = httpx.ASGITransport(app=asgi_app, raise_app_exceptions=False)
+    return httpx.AsyncClient(transport=transport, base_url="http://bench",
+                             timeout=300, headers={"Authorization": f"Bearer {api_key}"})
+
+
+async def run(args, questions):
+    sys.path.insert(0, API)
+    import app as api
+    from bench_e2e import API_KEY, percentiles
+
+    embed_ms = float(os.environ.get("FAKE_EMBED_LATENCY_MS", "50"))
+    chat_ms = float(os.environ.get("FAKE_CHAT_LATENCY_MS", "800"))
+    baseline, pool = sync_app(args.database_url, os.environ["OPENAI_BASE_URL"], args.version)
+    pool.open(wait=True)
+    levels = []
+    try:
+        async with api.lifespan(api.app), client_for(baseline, API_KEY) as sync_http, \
+                client_for(api.app, API_KEY) as async_http:
+            warmup = [f"warmup {i}" for i in range(args.warmup)]
+            await drive(sync_http, warmup, 4, percentiles)
+            await drive(async_http, warmup, 4, percentiles)
+            for n, concurrency in enumerate(args.concurrency):
+                batch = questions[2 * n * args.requests:2 * (n + 1) * args.requests]
+                sync = await drive(sync_http, batch[:args.requests], concurrency, percentiles)
+                async_ = await drive(async_http, batch[args.requests:], concurrency, percentiles)
+                levels.append({"concurrency": concurrency,
+                               "ideal_rps": round(concurrency / ((embed_ms + chat_ms) / 1000), 1),
+                               "sync": sync, "async": async_,
+                               "speedup": round(sync["seconds"] / async_["seconds"], 2)})
+    finally:
+        pool.close()
+    return levels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="postgresql://root@localhost:26257/defaultdb?sslmode=disable")
+    parser.add_argument("--version", default="bench")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--requests", type=int, default=400, help="requests per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 40, 400])
+    parser.add_argument("--warmup", type=int, default=8)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--app-env", nargs="*", default=[], metavar="KEY=VALUE")
+    args = parser.parse_args()
+
+    from bench_e2e import seed
+    corpus = seed(args.database_url, args.version, args.rows, args.dimensions, chunk_words=300)
+
+    # The app reads its settings at import. Admission is opened up to the
+    # highest concurrency so the bench measures the event loop, not the queues.
+    most = str(max(args.concurrency))
+    for name in ("ADMISSION_DB_QUEUE", "ADMISSION_LLM_LIMIT", "ADMISSION_LLM_QUEUE"):
+        os.environ.setdefault(name, most)
+    os.environ.setdefault("FAKE_EMBED_DIMENSIONS", str(args.dimensions))
+    os.environ.update(OPENAI_BASE_URL=f"http://127.0.0.1:{args.port}/v1", OPENAI_API_KEY="fake",
+                      DATABASE_URL=args.database_url, DEFAULT_VERSION=args.version,
+                      **dict(kv.split("=", 1) for kv in args.app_env))
+
+    questions = [f"question {i}" for i in range(2 * args.requests * len(args.concurrency))]
+    server = start_fake_server(args.port)
+    try:
+        levels = asyncio.run(run(args, questions))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(json.dumps({"corpus": corpus, "embed_latency_ms": os.environ.get("FAKE_EMBED_LATENCY_MS", "50"),
+                      "chat_latency_ms": os.environ.get("FAKE_CHAT_LATENCY_MS", "800"),
+                      "levels": levels}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
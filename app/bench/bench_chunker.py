@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Throughput, peak memory and chunk-size spread of the loader's chunkers.
+
+Compares the old read-and-split-on-"# " approach with MarkdownChunker on a
+crawled corpus (--glob) or on a generated one of --megabytes size.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from glob import glob
+
+import tiktoken
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "loader"))
+from chunker import MarkdownChunker  # noqa: E402
+
+
+def generate_corpus(directory, megabytes, seed=0):
+    """Write markdown files with nested headings, prose, lists and code fences."""
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(5000)]
+    target = megabytes * 1024 * 1024
+    written, n = 0, 0
+    while written < target:
+        lines = [f"# Page {n}\n\n"]
+        for s in range(rng.randint(3, 12)):
+            lines.append(f"{'#' * rng.randint(2, 4)} Section {s}\n\n")
+            for _ in range(rng.randint(1, 6)):
+                kind = rng.random()
+                if kind < 0.15:
+                    lines.append("~~~ sql\n")
+                    lines += [f"SELECT {rng.choice(words)} FROM t{i};\n" for i in range(rng.randint(2, 40))]
+                    lines.append("~~~\n\n")
+                elif kind < 0.3:
+                    lines += [f"- {' '.join(rng.choices(words, k=rng.randint(3, 15)))}\n"
+                              for _ in range(rng.randint(2, 8))]
+                    lines.append("\n")
+                else:
+                    # occasional huge paragraph, like crawled tables or nav dumps
+                    k = rng.randint(2000, 9000) if rng.random() < 0.02 else rng.randint(10, 200)
+                    lines.append(" ".join(rng.choices(words, k=k)) + "\n\n")
+        text = "".join(lines)
+        with open(os.path.join(directory, f"page{n}.md"), "w") as f:
+            f.write(text)
+        written += len(text)
+        n += 1
+    return written
+
+
+def split_chunks(pattern, delimiter="# "):
+    """The original chunking(): read each file fully and split on the delimiter."""
+    chunks = []
+    for file_path in glob(pattern, recursive=True):
+        with open(file_path, "r") as file:
+            file_text = file.read()
+        chunks += file_text.split(delimiter)
+    return chunks
+
+
+def measure(name, produce, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    sizes = [count(c) for c in produce()]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sizes.sort()
+    pct = lambda p: sizes[min(len(sizes) - 1, int(p * len(sizes)))]  # noqa: E731
+    return name, {
+        "chunks": len(sizes),
+        "seconds": round(elapsed, 3),
+        "peak_mb": round(peak / 1024 / 1024, 1),
+        "tokens_min": sizes[0], "tokens_p50": pct(0.5), "tokens_p95": pct(0.95),
+        "tokens_max": sizes[-1],
+        "over_8191": sum(1 for s in sizes if s > 8191),
+        "under_32": sum(1 for s in sizes if s < 32),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--glob", help="markdown files to chunk, e.g. 'crawl/**/*.md'")
+    parser.add_argument("--megabytes", type=int, default=50, help="size of the generated corpus")
+    parser.add_argument("--chunk-tokens", type=int, default=512)
+    parser.add_argument("--chunk-overlap", type=int, default=64)
+    args = parser.parse_args()
+
+    encoding = tiktoken.get_encoding("cl100k_base")
+    count = lambda text: len(encoding.encode(text, disallowed_special=()))  # noqa: E731
+    chunker = MarkdownChunker(encoding, args.chunk_tokens, args.chunk_overlap)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pattern = args.glob
+        corpus_bytes = sum(os.path.getsize(p) for p in glob(pattern, recursive=True)) if pattern else \
+            generate_corpus(tmp, args.megabytes)
+        pattern = pattern or os.path.join(tmp, "*.md")
+
+        # token counting is part of both runs, since the new chunker has to do it anyway
+        results = dict([
+            measure("split", lambda: split_chunks(pattern), count),
+            measure("markdown_chunker", lambda: chunker.chunk_glob(pattern), lambda c: c.tokens),
+        ])
+    for r in results.values():
+        r["mb_per_sec"] = round(corpus_bytes / 1024 / 1024 / r["seconds"], 2)
+    print(json.dumps({"corpus_mb": round(corpus_bytes / 1024 / 1024, 1), **results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
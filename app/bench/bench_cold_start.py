@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Cold start of the API: import time, time to ready and to the first answer.
+
+Import time is measured in a fresh interpreter for `app` (with the slowest
+modules from -X importtime) and, for comparison, for sentence_transformers,
+which app.py used to import at load. Then, --runs times, uvicorn is started
+against fake_openai.py and a local cluster (seeded as in bench_e2e.py) and
+the time from process start to /ready answering 200 and to the first
+successful /rag is recorded.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API = os.path.join(HERE, "..", "api")
+from bench_async import start_fake_server  # noqa: E402
+from bench_e2e import API_KEY, seed  # noqa: E402
+
+
+def import_time(module, env, top=5):
+    """(seconds, slowest modules) of importing module in a fresh interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=API, env=env,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None, proc.stderr.strip().splitlines()[-1:]
+    # -X importtime lines: "import time: self [us] | cumulative | imported package"
+    modules = []
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            modules.append((int(parts[1]), parts[2].strip()))
+    slowest = [{"module": name.strip(), "ms": round(us / 1000, 1)}
+               for us, name in sorted(modules, reverse=True)[:top]]
+    return round(float(proc.stdout.strip().splitlines()[-1]), 3), slowest
+
+
+def wait_for(url, start, deadline, headers=None, params=None):
+    """Seconds since start until url answers 200, or None at deadline."""
+    while time.perf_counter() < deadline:
+        try:
+            if httpx.get(url, headers=headers, params=params, timeout=30).status_code == 200:
+                return round(time.perf_counter() - start, 3)
+        except httpx.TransportError:
+            pass
+        time.sleep(0.05)
+    return None
+
+
+def cold_start(port, env, timeout):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port),
+                             "--log-level", "warning"], cwd=API, env=env)
+    deadline = start + timeout
+    try:
+        base = f"http://127.0.0.1:{port}"
+        listening = wait_for(f"{base}/metrics", start, deadline)
+        ready = wait_for(f"{base}/ready", start, deadline)
+        first = wait_for(f"{base}/rag", start, deadline, headers={"Authorization": f"Bearer {API_KEY}"},
+                         params={"question": "what is a vector index"})
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {"listening_s": listening, "ready_s": ready, "first_answer_s": first}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database-url", default="postgresql://root@localhost:26257/defaultdb?sslmode=disable")
+    parser.add_argument("--version", default="bench")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--fake-port", type=int, default=8100)
+    parser.add_argument("--app-port", type=int, default=8200)
+    parser.add_argument("--app-env", nargs="*", default=[], metavar="KEY=VALUE")
+    args = parser.parse_args()
+
+    env = {**os.environ, "OPENAI_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+           "OPENAI_API_KEY": "fake", "DATABASE_URL": args.database_url,
+           "DEFAULT_VERSION": args.version, **dict(kv.split("=", 1) for kv in args.app_env)}
+    results = {}
+    for module in ("app", "sentence_transformers"):
+        seconds, slowest = import_time(module, env)
+        results[f"import_{module}"] = {"seconds": seconds, "slowest": slowest}
+
+    seed(args.database_url, args.version, args.rows, args.dimensions, 300)
+    os.environ["FAKE_EMBED_DIMENSIONS"] = str(args.dimensions)
+    fake = start_fake_server(args.fake_port)
+    try:
+        runs = [cold_start(args.app_port, env, args.timeout) for _ in range(args.runs)]
+    finally:
+        fake.terminate()
+        fake.wait()
+    for key in ("listening_s", "ready_s", "first_answer_s"):
+        samples = [run[key] for run in runs if run[key] is not None]
+        results[key] = {"median": round(float(np.median(samples)), 3) if samples else None,
+                        "max": max(samples) if samples else None,
+                        "failed": len(runs) - len(samples)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
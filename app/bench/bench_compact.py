@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Recall@k, vector index size and latency of compact candidate search + rerank.
+
+Each mode finds --candidates nearest neighbours on a reduced copy of the
+embeddings (PCA fit on the corpus, or the first n dimensions) and reranks
+them on the full vectors, compared with an exact search on the full vectors.
+Index size is the vector payload the index has to hold (rows x dimensions x
+4 bytes).
+
+The corpus is synthetic (clustered, --dimensions wide) or a saved (n, d)
+float32 matrix of real embeddings (--embeddings file.npy), which is what
+"truncate" needs to be meaningful. With --database-url the SQL retrieval query
+is also timed on a version loaded with --compact-dimensions, full vs. compact.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+from compact import Projection, fit_pca  # noqa: E402
+from bench_local_index import corpus, percentiles, questions, recall  # noqa: E402
+
+FULL_SQL = """
+    SELECT url, text, embedding <-> %(embedding)s AS distance, id
+    FROM embeddings WHERE version = %(version)s
+    ORDER BY embedding <-> %(embedding)s LIMIT %(k)s
+"""
+COMPACT_SQL = """
+    WITH candidates AS (
+        SELECT id FROM embeddings WHERE version = %(version)s
+        ORDER BY embedding_compact <-> %(compact)s LIMIT %(candidates)s
+    )
+    SELECT url, text, embedding <-> %(embedding)s AS distance, id
+    FROM embeddings WHERE id IN (SELECT id FROM candidates)
+    ORDER BY distance LIMIT %(k)s
+"""
+
+
+def top(matrix, norms, query, n):
+    d2 = norms - 2 * matrix @ query
+    idx = np.argpartition(d2, n - 1)[:n]
+    return idx[np.argsort(d2[idx])]
+
+
+def offline(args, vectors):
+    queries = questions(vectors, args.queries)
+    norms = (vectors ** 2).sum(axis=1)
+    truth = [set(top(vectors, norms, q, args.k).tolist()) for q in queries]
+
+    modes = {"full": None}
+    for dims in args.compact_dimensions:
+        modes[f"pca{dims}"] = fit_pca(vectors, dims)
+        modes[f"truncate{dims}"] = Projection("truncate", dims)
+
+    results = {}
+    for label, projection in modes.items():
+        if projection is None:
+            reduced, reduced_norms = vectors, norms
+        else:
+            reduced = projection.project(vectors)
+            reduced_norms = (reduced ** 2).sum(axis=1)
+        samples, found = [], []
+        for q in queries:
+            start = time.perf_counter()
+            if projection is None:
+                hits = top(vectors, norms, q, args.k)
+            else:
+                candidates = top(reduced, reduced_norms, projection.project(q), args.candidates)
+                hits = candidates[top(vectors[candidates], norms[candidates], q, args.k)]
+            samples.append(time.perf_counter() - start)
+            found.append(set(hits.tolist()))
+        results[label] = {**percentiles(samples), f"recall@{args.k}": recall(found, truth),
+                          "index_mb": round(reduced.nbytes / 2 ** 20, 1)}
+    return results
+
+
+def online(args):
+    import psycopg
+    from psycopg.types import TypeInfo
+    from compact import load_projection
+    from vectors import register_vector
+
+    with psycopg.connect(args.database_url, autocommit=True) as conn:
+        register_vector(conn, TypeInfo.fetch(conn, "vector"))
+        projection = load_projection(conn, args.version)
+        if projection is None:
+            raise SystemExit(f"{args.version} has no compact projection; load it with --compact-dimensions")
+        rows = conn.execute("SELECT id, embedding FROM embeddings WHERE version = %s",
+                            (args.version,)).fetchall()
+        ids = [row[0] for row in rows]
+        vectors = np.stack([row[1] for row in rows])
+        norms = (vectors ** 2).sum(axis=1)
+        queries = questions(vectors, args.queries)
+        truth = [{ids[i] for i in top(vectors, norms, q, args.k)} for q in queries]
+
+        results = {"rows": len(ids)}
+        for label, sql in (("sql_full", FULL_SQL), (f"sql_{projection.kind}{projection.dimensions}", COMPACT_SQL)):
+            samples, found = [], []
+            for q in queries:
+                params = {"version": args.version, "embedding": q, "k": args.k,
+                          "compact": projection.project(q), "candidates": args.candidates}
+                start = time.perf_counter()
+                found.append({row[3] for row in conn.execute(sql, params, prepare=True).fetchall()})
+                samples.append(time.perf_counter() - start)
+            results[label] = {**percentiles(samples), f"recall@{args.k}": recall(found, truth)}
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--embeddings", default=None, help="(n, d) float32 .npy of real embeddings")
+    parser.add_argument("--compact-dimensions", type=int, nargs="+", default=[128, 256])
+    parser.add_argument("--candidates", type=int, default=40)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--version", default="v25.2")
+    args = parser.parse_args()
+
+    if args.database_url:
+        results = online(args)
+    else:
+        vectors = (np.load(args.embeddings).astype(np.float32) if args.embeddings
+                   else corpus(args.rows, args.dimensions))
+        results = offline(args, vectors)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
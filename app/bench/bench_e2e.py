@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""End-to-end load test of the API against local stand-ins.
+
+Starts fake_openai.py and the FastAPI app (uvicorn, app/api) pointed at it
+and at a local CockroachDB, seeds --version with a synthetic corpus of --rows
+chunks whose vectors are the fake server's embeddings of their text, then
+drives GET /rag at each --concurrency and prints JSON: requests per second,
+client latency and the p50/p95/p99 of every stage from the Server-Timing
+header, plus errors by kind. Everything is seeded, so two runs of the same
+command on the same machine are comparable, e.g. release to release:
+
+    python bench_e2e.py --start-db --rows 20000 --concurrency 8 32 --output before.json
+
+--start-db runs crdb/docker-compose.yaml (single node, insecure); otherwise
+--database-url must point at a running cluster. Extra settings for the app
+go in --app-env, e.g. --app-env LOCAL_INDEX_PATH=/tmp/idx CONTEXT_MAX_TOKENS=1000.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import numpy as np
+import psycopg
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..", "..")
+API = os.path.join(HERE, "..", "api")
+from bench_async import start_fake_server  # noqa: E402
+from fake_openai import fake_embedding  # noqa: E402
+
+API_KEY = "bench_e2e_key"
+WORDS = ("cluster node range replica lease vector index query table column region zone "
+         "transaction schema backup changefeed latency follower read write").split()
+
+
+def load_loader():
+    """The loader script as a module, for its create_schema and write_rows."""
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    sys.path.insert(0, os.path.join(HERE, "..", "loader"))
+    spec = importlib.util.spec_from_file_location(
+        "create_embeddings", os.path.join(HERE, "..", "loader", "create-embeddings.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def start_db(database_url, timeout=90):
+    subprocess.run(["docker", "compose", "-f", os.path.join(ROOT, "crdb", "docker-compose.yaml"),
+                    "up", "-d"], check=True, cwd=os.path.join(ROOT, "crdb"))
+    deadline = time.time() + timeout
+    while True:
+        try:
+            psycopg.connect(database_url, connect_timeout=2).close()
+            return
+        except psycopg.OperationalError:
+            if time.time() > deadline:
+                raise
+            time.sleep(1)
+
+
+def synthetic_text(rng, words):
+    return " ".join(rng.choice(WORDS, words))
+
+
+def seed(database_url, version, rows, dimensions, chunk_words, batch_size=500, seed_=0):
+    """Load rows synthetic chunks into version (skipped if already there) and the bench API key."""
+    loader = load_loader()
+    with psycopg.connect(database_url, application_name="bench_e2e") as conn:
+        loader.create_schema(conn, dimensions)
+        info = loader.fetch_vector_info(conn)
+        if info is not None:
+            loader.probe_binary(conn, info)
+        else:
+            loader.register_vector(conn)
+        conn.execute("INSERT INTO api_keys (key, user_id) VALUES (%s, 'bench') ON CONFLICT (key) DO NOTHING",
+                     (API_KEY,))
+        existing = conn.execute("SELECT count(*) FROM embeddings WHERE version = %s", (version,)).fetchone()[0]
+        if existing == rows:
+            return {"rows": rows, "seeded": 0}
+
+        conn.execute("DELETE FROM embeddings WHERE version = %s", (version,))
+        rng = np.random.default_rng(seed_)
+        start = time.perf_counter()
+        for offset in range(0, rows, batch_size):
+            batch = []
+            for i in range(offset, min(offset + batch_size, rows)):
+                text = f"chunk {i}: " + synthetic_text(rng, chunk_words)
+                batch.append((uuid.uuid5(uuid.NAMESPACE_URL, f"bench-e2e/{version}/{i}"), version,
+                              f"https://bench.local/{i // 20}", text, None, loader.count_prompt_tokens(text), None,
+                              fake_embedding(text, dimensions)))
+            loader.write_rows(conn, batch)
+        return {"rows": rows, "seeded": rows, "seed_seconds": round(time.perf_counter() - start, 1)}
+
+
+def start_app(port, env, workers):
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(port),
+                             "--workers", str(workers), "--log-level", "warning"],
+                            cwd=API, env=env)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("API server exited during startup")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/metrics")
+            return proc
+        except httpx.TransportError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("API server did not start")
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in header.split(","):
+        name, _, dur = part.strip().partition(";dur=")
+        if dur:
+            stages[name] = float(dur)
+    return stages
+
+
+def percentiles(ms):
+    ms = np.asarray(ms)
+    return {f"p{p}_ms": round(float(np.percentile(ms, p)), 2) for p in (50, 95, 99)}
+
+
+async def drive(base_url, questions, concurrency):
+    """Send every question to /rag with concurrency in flight; latencies, stage timings, errors."""
+    latencies, stages, errors = [], {}, {}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits,
+                                 headers={"Authorization": f"Bearer {API_KEY}"}) as http:
+
+        async def one(question):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await http.get("/rag", params={"question": question})
+                except httpx.HTTPError as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                    return
+                if response.status_code != 200:
+                    errors[str(response.status_code)] = errors.get(str(response.status_code), 0) + 1
+                    return
+                latencies.append((time.perf_counter() - start) * 1000)
+                for name, ms in parse_server_timing(response.headers.get("server-timing", "")).items():
+                    stages.setdefault(name, []).append(ms)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(q) for q in questions))
+        elapsed = time.perf_counter() - start
+    return {"concurrency": concurrency, "requests": len(questions), "ok": len(latencies),
+            "rps": round(len(latencies) / elapsed, 1), "errors": errors,
+            "latency": percentiles(latencies) if latencies else None,
+            "stages": {name: percentiles(ms) for name, ms in stages.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="postgresql://root@localhost:26257/defaultdb?sslmode=disable")
+    parser.add_argument("--start-db", action="store_true", help="docker compose up crdb/docker-compose.yaml")
+    parser.add_argument("--version", default="bench")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--chunk-words", type=int, default=300)
+    parser.add_argument("--requests", type=int, default=500, help="requests per concurrency level")
+    parser.add_argument("--distinct-questions", type=int, default=None,
+                        help="question pool size (default: every request distinct, so no cache hits)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--embed-latency-ms", type=float, default=50)
+    parser.add_argument("--chat-latency-ms", type=float, default=800)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--fake-port", type=int, default=8100)
+    parser.add_argument("--app-port", type=int, default=8200)
+    parser.add_argument("--app-env", nargs="*", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="also write the JSON report here")
+    args = parser.parse_args()
+
+    if args.start_db:
+        start_db(args.database_url)
+    corpus = seed(args.database_url, args.version, args.rows, args.dimensions, args.chunk_words,
+                  seed_=args.seed)
+
+    os.environ.update(FAKE_EMBED_LATENCY_MS=str(args.embed_latency_ms),
+                      FAKE_CHAT_LATENCY_MS=str(args.chat_latency_ms),
+                      FAKE_EMBED_DIMENSIONS=str(args.dimensions))
+    fake = start_fake_server(args.fake_port)
+    env = {**os.environ, "OPENAI_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+           "OPENAI_API_KEY": "fake", "DATABASE_URL": args.database_url,
+           "DEFAULT_VERSION": args.version,
+           **dict(kv.split("=", 1) for kv in args.app_env)}
+    app = None
+    try:
+        app = start_app(args.app_port, env, args.workers)
+        base_url = f"http://127.0.0.1:{args.app_port}"
+        rng = np.random.default_rng(args.seed + 1)
+        pool_size = args.distinct_questions or args.requests * len(args.concurrency)
+        pool = [f"how does {synthetic_text(rng, 3)} work ({i})" for i in range(pool_size)]
+        asyncio.run(drive(base_url, [f"warmup {i}" for i in range(args.warmup)], 4))
+        levels = []
+        for n, concurrency in enumerate(args.concurrency):
+            if args.distinct_questions:
+                questions = [pool[i] for i in rng.integers(0, pool_size, args.requests)]
+            else:
+                questions = pool[n * args.requests:(n + 1) * args.requests]
+            levels.append(asyncio.run(drive(base_url, questions, concurrency)))
+    finally:
+        for proc in (app, fake):
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+
+    report = {"config": {k: v for k, v in vars(args).items() if k not in ("output", "start_db", "database_url")},
+              "corpus": corpus, "levels": levels}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Question embedding latency of the embedding backends in embeddings.py.
+
+"openai" embeds against fake_openai.py (set FAKE_EMBED_LATENCY_MS to the
+round-trip you see in production), "local" runs all-MiniLM-L6-v2 on CPU
+(--onnx-path for onnxruntime). Each backend is measured one question at a
+time and with --concurrency questions in flight; for the local backend the
+concurrent run is repeated with micro-batching off (max_batch=1).
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from openai import AsyncOpenAI
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+from embeddings import create_backend  # noqa: E402
+from bench_async import start_fake_server  # noqa: E402
+
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 2),
+            "p95_ms": round(float(np.percentile(ms, 95)), 2)}
+
+
+async def timed(backend, question):
+    start = time.perf_counter()
+    await backend.embed([question])
+    return time.perf_counter() - start
+
+
+async def sequential(backend, questions):
+    return percentiles([await timed(backend, q) for q in questions])
+
+
+async def concurrent(backend, questions, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(question):
+        async with semaphore:
+            return await timed(backend, question)
+
+    start = time.perf_counter()
+    samples = await asyncio.gather(*(one(q) for q in questions))
+    elapsed = time.perf_counter() - start
+    return {**percentiles(samples), "questions_per_sec": round(len(questions) / elapsed, 1)}
+
+
+async def run(backend, questions, concurrency):
+    await backend.embed(["warm up"])
+    return {"sequential": await sequential(backend, questions),
+            "concurrent": await concurrent(backend, questions, concurrency)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backends", nargs="+", default=["openai", "local"])
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--onnx-path", default=None)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+
+    questions = [f"how do I create a vector index on table {i}?" for i in range(args.questions)]
+    results = {}
+    if "openai" in args.backends:
+        server = start_fake_server(args.port)
+        try:
+            client = AsyncOpenAI(api_key="bench", base_url=f"http://127.0.0.1:{args.port}/v1")
+            results["openai"] = asyncio.run(run(create_backend("openai", async_client=client),
+                                                questions, args.concurrency))
+        finally:
+            server.terminate()
+    if "local" in args.backends:
+        for label, max_batch in (("local", 64), ("local_unbatched", 1)):
+            backend = create_backend("local", onnx_path=args.onnx_path, threads=args.threads,
+                                     max_batch=max_batch)
+            results[label] = asyncio.run(run(backend, questions, args.concurrency))
+            results[label]["batches"] = backend.batcher.stats()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Retrieval latency per node, strongly consistent vs. follower reads.
+
+Runs the /rag retrieval query against every node URL with and without
+AS OF SYSTEM TIME follower_read_timestamp(), using random stored embeddings
+of --version as questions, e.g. against crdb/docker-multinode.yaml:
+
+    python bench_follower_reads.py --urls \\
+        postgresql://root@localhost:26257/defaultdb?sslmode=disable \\
+        postgresql://root@localhost:26258/defaultdb?sslmode=disable \\
+        postgresql://root@localhost:26259/defaultdb?sslmode=disable
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+import psycopg
+from psycopg.types import TypeInfo
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+from vectors import register_vector  # noqa: E402
+from bench_local_index import percentiles  # noqa: E402
+
+QUERY = """
+    SELECT url, text, embedding <-> %(embedding)s AS distance, id
+    FROM embeddings {as_of}
+    WHERE version = %(version)s
+    ORDER BY embedding <-> %(embedding)s
+    LIMIT %(k)s
+"""
+MODES = {"strong": "", "follower": "AS OF SYSTEM TIME follower_read_timestamp()"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--urls", nargs="+", required=True)
+    parser.add_argument("--version", default="v25.2")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    with psycopg.connect(args.urls[0], autocommit=True) as conn:
+        register_vector(conn, TypeInfo.fetch(conn, "vector"))
+        questions = [row[0] for row in conn.execute(
+            "SELECT embedding FROM embeddings WHERE version = %s ORDER BY random() LIMIT %s",
+            (args.version, args.queries)).fetchall()]
+
+    results = {}
+    for url in args.urls:
+        parts = urlsplit(url)
+        node = results.setdefault(f"{parts.hostname}:{parts.port or 26257}", {})
+        with psycopg.connect(url, autocommit=True) as conn:
+            register_vector(conn, TypeInfo.fetch(conn, "vector"))
+            for mode, as_of in MODES.items():
+                sql = QUERY.format(as_of=as_of)
+                samples = []
+                for q in questions:
+                    start = time.perf_counter()
+                    conn.execute(sql, {"embedding": np.asarray(q), "version": args.version, "k": args.k},
+                                 prepare=True).fetchall()
+                    samples.append(time.perf_counter() - start)
+                node[mode] = percentiles(samples)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
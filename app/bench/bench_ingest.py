@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Throughput of the loader's ingestion pipeline against fake_openai.py.
+
+Runs the same synthetic corpus through IngestPipeline at each requested
+concurrency. Writes go to an in-memory sink that sleeps --write-latency-ms per
+transaction and fails a fraction of them with a 40001 retry error, so the
+DB retry path is exercised without a cluster. Each level gets its own fake
+server, so with FAKE_EMBED_TPM set every level starts with the same budget.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from openai import OpenAI
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "loader"))
+from pipeline import IngestPipeline  # noqa: E402
+from bench_async import start_fake_server  # noqa: E402
+
+
+class RetryableError(Exception):
+    sqlstate = "40001"
+
+
+def synthetic_chunks(n, words):
+    rng = random.Random(0)
+    vocab = [f"word{i}" for i in range(2000)]
+    return [" ".join(rng.choice(vocab) for _ in range(words)) for _ in range(n)]
+
+
+def batches(chunks, batch_size):
+    items = list(enumerate(chunks))
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def run(base_url, chunks, args, concurrency):
+    client = OpenAI(api_key="fake", base_url=base_url, max_retries=0)
+    rng = random.Random(1)
+
+    def embed(texts):
+        response = client.embeddings.create(input=texts, model="text-embedding-ada-002")
+        return [d.embedding for d in response.data]
+
+    def write(rows):
+        time.sleep(args.write_latency_ms / 1000)
+        if rng.random() < args.conflict_rate:
+            raise RetryableError("restart transaction")
+
+    ingest = IngestPipeline(embed, lambda key, text, embedding: (key, len(embedding)), write,
+                            lambda text: len(text.split()), concurrency=concurrency,
+                            tokens_per_minute=args.tokens_per_minute,
+                            insert_batch_size=args.insert_batch_size)
+    stats = ingest.run(batches(chunks, args.embed_batch_size))
+    stats["chunks_per_sec"] = round(stats["written"] / stats["seconds"], 1)
+    stats["seconds"] = round(stats["seconds"], 3)
+    stats["failed"] = len(ingest.errors)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--words", type=int, default=200, help="words per chunk")
+    parser.add_argument("--embed-batch-size", type=int, default=32)
+    parser.add_argument("--insert-batch-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--tokens-per-minute", type=int, default=None)
+    parser.add_argument("--write-latency-ms", type=float, default=20)
+    parser.add_argument("--conflict-rate", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+
+    chunks = synthetic_chunks(args.chunks, args.words)
+    base_url = f"http://127.0.0.1:{args.port}/v1"
+    results = {}
+    for concurrency in args.concurrency:
+        # A fresh server per level, so each starts with a full FAKE_EMBED_TPM bucket
+        server = start_fake_server(args.port)
+        try:
+            results[str(concurrency)] = run(base_url, chunks, args, concurrency)
+        finally:
+            server.terminate()
+            server.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
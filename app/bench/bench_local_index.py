@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Recall and latency of the local search tier (local_index.py).
+
+Without --database-url a clustered synthetic corpus is written as a local
+index in a temp directory and searched as float32, float16, int8 and binary
+(both reranked against float32), and float16 with an IVF coarse index,
+against an exact float32 brute force as ground truth.
+
+With --database-url the index is synced from the embeddings table for
+--version and compared with the SQL path (ORDER BY embedding <-> %s LIMIT k),
+using stored chunks plus noise as questions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+from local_index import LocalIndex, VersionIndex, kmeans, read_meta, write_generation  # noqa: E402
+
+
+def corpus(rows, dimensions, clusters=200, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, rows)] + 0.5 * rng.standard_normal((rows, dimensions)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def questions(vectors, n, seed=1):
+    rng = np.random.default_rng(seed)
+    q = vectors[rng.integers(0, len(vectors), n)] + 0.02 * rng.standard_normal((n, vectors.shape[1])).astype(np.float32)
+    return q.astype(np.float32)
+
+
+def percentiles(samples):
+    ms = np.array(samples) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(ms, 95)), 3)}
+
+
+def recall(found, truth):
+    return round(float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])), 4)
+
+
+def file_mb(directory, meta):
+    prefix = os.path.join(directory, meta["version"]) + f".{meta['generation']}."
+    return round(sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory)
+                     if os.path.join(directory, f).startswith(prefix)) / 2 ** 20, 1)
+
+
+def offline(args):
+    vectors = corpus(args.rows, args.dimensions)
+    ids = np.array([uuid.uuid4().bytes for _ in range(args.rows)], dtype="S16")
+    queries = questions(vectors, args.queries)
+    # exact float32 ground truth, all queries in one matmul
+    d2 = (vectors ** 2).sum(axis=1)[:, None] - 2 * vectors @ queries.T
+    truth = [{ids[i:i + 1].tobytes() for i in np.argsort(d2[:, j])[:args.k]} for j in range(len(queries))]
+
+    results = {}
+    centroids = kmeans(vectors, args.nlist) if args.nlist else None
+    layouts = [(dtype, dtype, None, None) for dtype in ("float32", "float16", "int8", "binary")]
+    if centroids is not None:
+        layouts += [(f"float16_ivf{args.nlist}_nprobe{p}", "float16", centroids, p) for p in args.nprobe]
+    with tempfile.TemporaryDirectory() as directory:
+        for label, dtype, cents, nprobe in layouts:
+            version = label.split("_nprobe")[0]
+            meta = read_meta(directory, version) or write_generation(
+                directory, version, 1, ids, vectors, 0, dtype=dtype, centroids=cents)
+            index = VersionIndex(directory, meta)
+            samples, found = [], []
+            for q in queries:
+                start = time.perf_counter()
+                hits = index.search(q, args.k, nprobe or 1, args.rerank)
+                samples.append(time.perf_counter() - start)
+                found.append({index.ids[row:row + 1].tobytes() for row, _ in hits})
+            # scan_mb: what a query reads (codes when quantized), size_mb: all files on disk
+            scanned = index.codes if index.quantized else index.vectors
+            results[label] = {**percentiles(samples), f"recall@{args.k}": recall(found, truth),
+                              "scan_mb": round(scanned.nbytes / 2 ** 20, 1),
+                              "size_mb": file_mb(directory, meta)}
+    return results
+
+
+async def online(args):
+    import psycopg
+    from psycopg.types import TypeInfo
+    from vectors import register_vector
+
+    results = {}
+    conn = await psycopg.AsyncConnection.connect(args.database_url, autocommit=True)
+    register_vector(conn, await TypeInfo.fetch(conn, "vector"))
+    with tempfile.TemporaryDirectory() as directory:
+        index = LocalIndex(directory, dtype=args.dtype, nlist=args.nlist, nprobe=max(args.nprobe),
+                           rerank=args.rerank)
+        start = time.perf_counter()
+        await index.refresh(conn)
+        results["sync_seconds"] = round(time.perf_counter() - start, 2)
+        local = index._versions[args.version]
+        stored = np.asarray(local.vectors, dtype=np.float32)
+        queries = questions(stored, args.queries)
+
+        local_samples, sql_samples, local_found, sql_found = [], [], [], []
+        for q in queries:
+            start = time.perf_counter()
+            hits = index.search(args.version, q, args.k)
+            local_samples.append(time.perf_counter() - start)
+            local_found.append({id_ for id_, _ in hits})
+            start = time.perf_counter()
+            cur = await conn.execute(
+                "SELECT id FROM embeddings WHERE version = %(version)s "
+                "ORDER BY embedding <-> %(embedding)s LIMIT %(k)s",
+                {"version": args.version, "embedding": q, "k": args.k}, prepare=True)
+            sql_found.append({row[0] for row in await cur.fetchall()})
+            sql_samples.append(time.perf_counter() - start)
+        results["rows"] = local.meta["rows"]
+        results["local"] = {**percentiles(local_samples), "size_mb": file_mb(directory, local.meta)}
+        results["sql"] = percentiles(sql_samples)
+        # how often the SQL (vector index) and local results agree
+        results[f"overlap@{args.k}"] = recall(sql_found, local_found)
+    await conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--nlist", type=int, default=256, help="IVF lists (0 = exact only)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--rerank", type=int, default=10, help="candidates per result for int8/binary")
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--version", default="v25.2")
+    args = parser.parse_args()
+
+    results = asyncio.run(online(args)) if args.database_url else offline(args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
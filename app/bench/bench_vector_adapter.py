@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Per-query cost of binding the question embedding, before and after vectors.py.
+
+"before" is the old path: the embedding as a list of Python floats turned
+into an f-string and bound twice. "text" and "binary" bind a float32 array
+once through the registered dumpers. Serialization time and parameter bytes
+are measured offline with psycopg's own query conversion. With --database-url
+the retrieval query is also timed against a live cluster.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import psycopg
+from psycopg._queries import PostgresQuery
+from psycopg.adapt import AdaptersMap, Transformer
+from psycopg.types import TypeInfo
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "api"))
+from vectors import register_vector  # noqa: E402
+
+BEFORE_SQL = """
+    SELECT url, text, embedding <-> %s AS distance, id
+    FROM embeddings WHERE version = %s
+    ORDER BY embedding <-> %s LIMIT %s;
+"""
+AFTER_SQL = """
+    SELECT url, text, embedding <-> %(embedding)s AS distance, id
+    FROM embeddings WHERE version = %(version)s
+    ORDER BY embedding <-> %(embedding)s LIMIT %(k)s;
+"""
+
+
+class Context:
+    connection = None
+
+    def __init__(self):
+        self.adapters = AdaptersMap(psycopg.adapters)
+
+
+def before_params(embedding):
+    embedding_str = f"[{','.join(map(str, embedding))}]"
+    return (embedding_str, "v25.2", embedding_str, 3)
+
+
+def after_params(embedding):
+    return {"embedding": np.asarray(embedding, dtype=np.float32), "version": "v25.2", "k": 3}
+
+
+def offline(mode, embedding, iterations):
+    context = Context()
+    if mode != "before":
+        # oid 8000 stands in for the server's VECTOR oid
+        register_vector(context, TypeInfo("vector", 8000, 8001), binary=(mode == "binary"))
+    sql, make_params = (BEFORE_SQL, before_params) if mode == "before" else (AFTER_SQL, after_params)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        query = PostgresQuery(Transformer(context))
+        query.convert(sql, make_params(embedding))
+    elapsed = time.perf_counter() - start
+    return {"serialize_us": round(elapsed / iterations * 1e6, 1),
+            "param_bytes": sum(len(p) for p in query.params if p is not None)}
+
+
+def online(mode, url, embedding, iterations):
+    with psycopg.connect(url, autocommit=True) as conn:
+        if mode == "before":
+            sql, params, prepare = BEFORE_SQL, lambda: before_params(embedding), None
+        else:
+            register_vector(conn, TypeInfo.fetch(conn, "vector"), binary=(mode == "binary"))
+            sql, params, prepare = AFTER_SQL, lambda: after_params(embedding), True
+        with conn.cursor() as cur:
+            cur.execute(sql, params(), prepare=prepare)  # warm up
+            start = time.perf_counter()
+            for _ in range(iterations):
+                cur.execute(sql, params(), prepare=prepare)
+                cur.fetchall()
+        return round((time.perf_counter() - start) / iterations * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--query-iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    # what the OpenAI client hands back: Python floats with full double precision
+    embedding = np.random.default_rng(0).standard_normal(args.dimensions).tolist()
+    results = {}
+    for mode in ("before", "text", "binary"):
+        results[mode] = offline(mode, embedding, args.iterations)
+        if args.database_url:
+            results[mode]["query_ms"] = online(mode, args.database_url, embedding, args.query_iterations)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Local stand-in for the OpenAI embeddings and chat completions endpoints.
+
+Vectors are derived from a hash of the input text, so the same text always
+gets the same embedding, and each endpoint sleeps for a configurable time to
+mimic network and model latency. Point a client at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBED_LATENCY_MS = float(os.environ.get("FAKE_EMBED_LATENCY_MS", "50"))
+CHAT_LATENCY_MS = float(os.environ.get("FAKE_CHAT_LATENCY_MS", "800"))
+CHAT_TTFT_MS = float(os.environ.get("FAKE_CHAT_TTFT_MS", "200"))
+DIMENSIONS = int(os.environ.get("FAKE_EMBED_DIMENSIONS", "1536"))
+# Tokens per minute accepted by /v1/embeddings before answering 429 (0 = unlimited)
+EMBED_TPM = float(os.environ.get("FAKE_EMBED_TPM", "0"))
+
+app = FastAPI()
+_budget = {"tokens": EMBED_TPM, "updated": time.monotonic()}
+
+
+def take_tokens(n):
+    """Token bucket for the fake rate limit; returns seconds to wait, 0 if admitted."""
+    if not EMBED_TPM:
+        return 0
+    rate = EMBED_TPM / 60
+    now = time.monotonic()
+    _budget["tokens"] = min(EMBED_TPM, _budget["tokens"] + (now - _budget["updated"]) * rate)
+    _budget["updated"] = now
+    if _budget["tokens"] >= n:
+        _budget["tokens"] -= n
+        return 0
+    return (n - _budget["tokens"]) / rate
+
+
+def fake_embedding(text, dimensions=DIMENSIONS):
+    """Deterministic unit vector for text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vec = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    tokens = sum(len(t.split()) for t in inputs)
+    wait = take_tokens(tokens)
+    if wait:
+        return JSONResponse(status_code=429,
+                            headers={"retry-after": f"{wait:.3f}",
+                                     "x-ratelimit-remaining-tokens": str(int(_budget["tokens"])),
+                                     "x-ratelimit-reset-tokens": f"{wait * 1000:.0f}ms"},
+                            content={"error": {"message": "Rate limit reached for tokens per min",
+                                               "type": "tokens", "code": "rate_limit_exceeded"}})
+    await asyncio.sleep(EMBED_LATENCY_MS / 1000)
+    dimensions = body.get("dimensions") or DIMENSIONS
+    return {
+        "object": "list",
+        "model": body.get("model"),
+        "data": [{"object": "embedding", "index": i,
+                  "embedding": fake_embedding(text, dimensions).tolist()}
+                 for i, text in enumerate(inputs)],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    answer = "This is a canned answer from the fake OpenAI server."
+    if body.get("stream"):
+        return StreamingResponse(stream_chat(body.get("model"), answer),
+                                 media_type="text/event-stream")
+    await asyncio.sleep(CHAT_LATENCY_MS / 1000)
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": answer}}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+async def stream_chat(model, answer):
+    """Stream answer word by word: first token after CHAT_TTFT_MS, the rest
+    spread over the remainder of CHAT_LATENCY_MS."""
+    words = answer.split(" ")
+    gap = max(CHAT_LATENCY_MS - CHAT_TTFT_MS, 0) / 1000 / max(len(words) - 1, 1)
+    await asyncio.sleep(CHAT_TTFT_MS / 1000)
+    for i, word in enumerate(words):
+        if i:
+            await asyncio.sleep(gap)
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                 "created": int(time.time()), "model": model,
+                 "choices": [{"index": 0, "finish_reason": None,
+                              "delta": {"content": word if i == 0 else " " + word}}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+    done = {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+            "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "delta": {}}]}
+    yield f"data: {json.dumps(done)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI server for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    uvicorn.run("fake_openai:app", host=args.host, port=args.port,
+                workers=args.workers, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# coding: utf-8
+"""Markdown chunker that packs sections into token-sized chunks.
+
+Files are read line by line. Text is split into blocks (paragraphs, list
+runs, whole code fences) which are never cut unless a single block is over
+the size limit, and blocks are packed into chunks of about `target_tokens`
+tokens with `overlap_tokens` of trailing context (whole blocks, or the end
+of the last one) repeated at the start of the next chunk. Each chunk carries the heading breadcrumbs it starts under,
+e.g. "VECTOR > Syntax".
+"""
+import re
+from collections import namedtuple
+from glob import glob
+
+Chunk = namedtuple("Chunk", ["text", "headings", "tokens"])
+
+HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+FENCE = re.compile(r"^\s*(```+|~~~+)")
+
+
+class MarkdownChunker:
+
+    def __init__(self, encoding, target_tokens=512, overlap_tokens=64):
+        self.encoding = encoding
+        self.target_tokens = target_tokens
+        self.overlap_tokens = min(overlap_tokens, target_tokens // 2)
+        # Sections smaller than this are merged with the next one
+        self.min_tokens = target_tokens // 4
+
+    def count(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def blocks(self, lines):
+        """Yield (text, headings) blocks; headings is the breadcrumb list at the block."""
+        headings = []
+        buf = []
+        fence = None
+        for line in lines:
+            if fence is not None:
+                buf.append(line)
+                if line.strip().startswith(fence):
+                    fence = None
+                    yield "".join(buf), list(headings)
+                    buf = []
+                continue
+
+            match = FENCE.match(line)
+            if match:
+                if buf:
+                    yield "".join(buf), list(headings)
+                buf = [line]
+                fence = match.group(1)
+                continue
+
+            match = HEADING.match(line)
+            if match:
+                if buf:
+                    yield "".join(buf), list(headings)
+                    buf = []
+                level = len(match.group(1))
+                headings = headings[:level - 1] + [""] * (level - 1 - len(headings)) + [match.group(2)]
+                yield line, list(headings)
+                continue
+
+            if not line.strip():
+                if buf:
+                    buf.append(line)
+                    yield "".join(buf), list(headings)
+                    buf = []
+                continue
+            buf.append(line)
+        if buf:
+            yield "".join(buf), list(headings)
+
+    def split_block(self, text, tokens, limit=None):
+        """Cut a block that is bigger than limit (a chunk), on line boundaries where possible."""
+        limit = limit or self.target_tokens
+        if tokens <= limit:
+            yield text, tokens
+            return
+        piece, piece_tokens = [], 0
+        for line in text.splitlines(keepends=True):
+            n = self.count(line)
+            if n > limit:
+                if piece:
+                    yield "".join(piece), piece_tokens
+                    piece, piece_tokens = [], 0
+                ids = self.encoding.encode(line, disallowed_special=())
+                for i in range(0, len(ids), limit):
+                    part = ids[i:i + limit]
+                    yield self.encoding.decode(part), len(part)
+                continue
+            if piece and piece_tokens + n > limit:
+                yield "".join(piece), piece_tokens
+                piece, piece_tokens = [], 0
+            piece.append(line)
+            piece_tokens += n
+        if piece:
+            yield "".join(piece), piece_tokens
+
+    def tail(self, text, max_tokens):
+        """The last max_tokens tokens of text, from the first word boundary in them."""
+        ids = self.encoding.encode(text, disallowed_special=())
+        if max_tokens <= 0 or len(ids) <= 1:
+            return "", 0
+        tail = self.encoding.decode(ids[-max_tokens:])
+        boundary = re.search(r"\s", tail)
+        if boundary is not None and len(ids) > max_tokens:
+            tail = tail[boundary.end():]
+        return tail, self.count(tail)
+
+    def chunk_lines(self, lines):
+        """Pack the blocks of a markdown line stream into Chunks.
+
+        A heading always opens a chunk: headings left at the end of a full
+        chunk move to the next one with the block they introduce.
+        """
+        # buf holds (text, tokens, headings) with headings set on heading blocks only
+        buf, buf_tokens, buf_headings = [], 0, []
+
+        def emit():
+            text = "".join(t for t, _, _ in buf).strip()
+            return Chunk(text, " > ".join(h for h in buf_headings if h), buf_tokens)
+
+        def overlap(tokens):
+            """Trailing context of buf for a chunk whose next piece has tokens."""
+            budget = min(self.overlap_tokens, self.target_tokens - tokens)
+            carry, carry_tokens = [], 0
+            for prev, prev_tokens, prev_headings in reversed(buf[1:]):
+                if carry_tokens + prev_tokens > budget or prev_headings is not None:
+                    break
+                carry.insert(0, (prev, prev_tokens, None))
+                carry_tokens += prev_tokens
+            # Paragraphs are usually longer than the overlap: repeat the end of the last one
+            if not carry and buf[-1][2] is None:
+                text, n = self.tail(buf[-1][0], budget)
+                if n and n <= budget:
+                    carry, carry_tokens = [(text, n, None)], n
+            return carry, carry_tokens
+
+        for text, headings in self.blocks(lines):
+            is_heading = HEADING.match(text) is not None
+            # Start a new chunk at a heading once the current one is big enough
+            # (a run of headings stays together)
+            if is_heading and buf_tokens >= self.min_tokens and buf[-1][2] is None:
+                yield emit()
+                buf, buf_tokens = [], 0
+            # Headings at the end of buf go with this block, so leave room for them
+            lead = 0
+            for _, prev_tokens, prev_headings in reversed(buf):
+                if prev_headings is None:
+                    break
+                lead += prev_tokens
+            limit = self.target_tokens - lead if not is_heading and lead < self.target_tokens // 2 else None
+            for piece, tokens in self.split_block(text, self.count(text), limit):
+                if buf and buf_tokens + tokens > self.target_tokens:
+                    moved = []
+                    while not is_heading and buf and buf[-1][2] is not None:
+                        moved.insert(0, buf.pop())
+                    if moved:
+                        if buf:
+                            buf_tokens -= sum(n for _, n, _ in moved)
+                            yield emit()
+                        buf, buf_tokens, buf_headings = moved, sum(n for _, n, _ in moved), moved[0][2]
+                    else:
+                        yield emit()
+                        if is_heading:
+                            buf, buf_tokens = [], 0
+                        else:
+                            buf, buf_tokens = overlap(tokens)
+                        buf_headings = headings
+                if not buf:
+                    buf_headings = headings
+                buf.append((piece, tokens, headings if is_heading else None))
+                buf_tokens += tokens
+        if buf and any(t.strip() for t, _, _ in buf):
+            yield emit()
+
+    def chunk_file(self, path):
+        with open(path, "r") as file:
+            yield from self.chunk_lines(file)
+
+    def chunk_glob(self, pattern):
+        for file_path in glob(pattern, recursive=True):
+            yield from self.chunk_file(file_path)
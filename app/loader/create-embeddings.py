@@ -4,32 +4,106 @@ import argparse
 import os
 from glob import glob
 from openai import OpenAI
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 import uuid
+import hashlib
 import logging, psycopg
+import tiktoken
 from psycopg.rows import namedtuple_row
 import numpy as np
+from pipeline import IngestPipeline
+from chunker import MarkdownChunker
+import sys
+# numpy <-> VECTOR adapters are shared with the API server
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+from vectors import register_vector, fetch_vector_info, probe_binary, to_vector
+from embeddings import create_backend
+from compact import Projection, fit_pca, load_projection, store_projection
+from context import chat_encoding
+from dedup import NO_WORDS, SimHashIndex, simhash, to_signed, from_signed
 
-def create_schema (conn):
+def create_schema (conn, dimensions=1536, compact_dimensions=None):
 
     conn.autocommit = True
     with conn.cursor() as cur:
-            # openai embeddings has 1536 dimensions, while SentenceTransformer has 384
+            # openai embeddings has 1536 dimensions, while all-MiniLM-L6-v2 has 384;
+            # the column follows the embedding backend (--embedding-backend)
             cur.execute ("SET CLUSTER SETTING feature.vector_index.enabled = true;")
             cur.execute(
-                """CREATE TABLE IF NOT EXISTS public.embeddings  (
+                f"""CREATE TABLE IF NOT EXISTS public.embeddings  (
                      id UUID NOT NULL, 
                      version STRING NULL,
                      url STRING NULL,
                      text STRING NULL,
-                     embedding VECTOR(1536) NULL ,
+                     headings STRING NULL,
+                     tokens INT NULL,
+                     simhash INT8 NULL,
+                     embedding VECTOR({dimensions}) NULL ,
                      CONSTRAINT embeddings_pkey PRIMARY KEY (id ASC),
                      VECTOR INDEX (version, embedding)
                  );""" )
             logging.debug("create embeddings tables: status message: %s",
                           cur.statusmessage)
+            # heading breadcrumbs of each chunk, for tables created before the column existed
+            cur.execute("ALTER TABLE public.embeddings ADD COLUMN IF NOT EXISTS headings STRING NULL;")
+            # token count of text in the chat model's encoding (see count_prompt_tokens), so the
+            # API can budget the prompt before fetching text
+            cur.execute("ALTER TABLE public.embeddings ADD COLUMN IF NOT EXISTS tokens INT NULL;")
+            # SimHash fingerprint of text, written with --dedup (see dedup.py)
+            cur.execute("ALTER TABLE public.embeddings ADD COLUMN IF NOT EXISTS simhash INT8 NULL;")
+            cur.execute("SELECT data_type FROM [SHOW COLUMNS FROM public.embeddings] WHERE column_name = 'embedding'")
+            column_type = cur.fetchone()[0]
+            if column_type.upper() != f"VECTOR({dimensions})":
+                raise ValueError(f"embeddings.embedding is {column_type} but the embedding backend "
+                                 f"produces {dimensions} dimensions; use a new table or database")
+
+            if compact_dimensions:
+                # Reduced-dimension copy for the candidate search, reranked on embedding
+                cur.execute(f"ALTER TABLE public.embeddings ADD COLUMN IF NOT EXISTS "
+                            f"embedding_compact VECTOR({compact_dimensions}) NULL;")
+                cur.execute("SELECT data_type FROM [SHOW COLUMNS FROM public.embeddings] "
+                            "WHERE column_name = 'embedding_compact'")
+                column_type = cur.fetchone()[0]
+                if column_type.upper() != f"VECTOR({compact_dimensions})":
+                    raise ValueError(f"embeddings.embedding_compact is {column_type}, "
+                                     f"not VECTOR({compact_dimensions})")
+                cur.execute("CREATE VECTOR INDEX IF NOT EXISTS embeddings_compact_idx "
+                            "ON public.embeddings (version, embedding_compact);")
+                cur.execute(
+                    """CREATE TABLE IF NOT EXISTS embedding_projections (
+                        version STRING PRIMARY KEY,
+                        kind STRING NOT NULL,
+                        dimensions INT NOT NULL,
+                        mean BYTES NULL,
+                        components BYTES NULL
+                     );""" )
             
+            # One row per version, rewritten with every change to its chunks;
+            # API workers poll it to keep their local search index current
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS embedding_versions (
+                    version STRING PRIMARY KEY,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                 );""" )
+
+            # Chunks left out by --dedup link, with the stored chunk they duplicate;
+            # text and tokens let the loader load them if that chunk is deleted
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS chunk_duplicates (
+                    id UUID PRIMARY KEY,
+                    version STRING NOT NULL,
+                    url STRING NOT NULL,
+                    headings STRING NULL,
+                    canonical_id UUID NOT NULL,
+                    distance INT NOT NULL,
+                    text STRING NULL,
+                    tokens INT NULL,
+                    INDEX (version, url),
+                    INDEX (canonical_id)
+                 );""" )
+            cur.execute("ALTER TABLE chunk_duplicates ADD COLUMN IF NOT EXISTS text STRING NULL;")
+            cur.execute("ALTER TABLE chunk_duplicates ADD COLUMN IF NOT EXISTS tokens INT NULL;")
+
             cur.execute(
                 """CREATE TABLE IF NOT EXISTS api_keys (
                     id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -42,79 +116,480 @@ def create_schema (conn):
                           cur.statusmessage)
     return
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Retries are handled by the ingestion pipeline, which backs off across all workers
+client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+encoding = tiktoken.get_encoding("cl100k_base")  # tokenizer of text-embedding-ada-002
+prompt_encoding = chat_encoding()  # tokenizer of the API's chat model, for the tokens column
+# Set in main() from --embedding-backend
+backend = None
 
 def test():
     test_str = "CockroachDB test"
 
-    embedding = model.encode(test_str)
-    print(f"Embedding length: {len(embedding)}")
-    print("First few values:", embedding[:5])
-
-    response = client.embeddings.create(
-        input=[test_str],
-        model="text-embedding-ada-002"  # This is the current recommended embedding model
-    )
-    # Extract the embedding vector
-    embedding = response.data[0].embedding
-    print(f"Embedding length: {len(embedding)}")
-    print("First few values:", embedding[:5])
-
-def chunking(mdfile, delimiter):
-    text_lines = []
+    for embedder in (create_backend("local"), create_backend("openai", client=client)):
+        embedding = embedder.embed_sync([test_str])[0]
+        print(f"{embedder.name}: embedding length: {len(embedding)}")
+        print("First few values:", embedding[:5])
+
+def chunking(mdfile, chunk_tokens=512, chunk_overlap=64):
+    """Split the globbed markdown files into token-sized Chunks (see chunker.py)."""
+    chunker = MarkdownChunker(encoding, target_tokens=chunk_tokens, overlap_tokens=chunk_overlap)
+    chunks = []
     for file_path in glob(mdfile, recursive=True):
-        with open(file_path, "r") as file:
-            file_text = file.read()
-        text_lines += file_text.split(delimiter)
-        print (f"File: {file_path}, Number of lines: {len(text_lines)}")
-    return text_lines
+        chunks += chunker.chunk_file(file_path)
+        print (f"File: {file_path}, Number of chunks: {len(chunks)}")
+    return chunks
 
 def normalize_vector(vec):
     return (vec / np.linalg.norm(vec)).tolist()  # Normalize to unit length
 
-def insert_embeddings (conn, text_lines, version, url):
+MAX_BATCH_INPUTS = 2048    # per-request input limit of the embeddings API
+
+def count_tokens(text):
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_prompt_tokens(text):
+    """Tokens of text in the API's prompt, as stored in the tokens column."""
+    return len(prompt_encoding.encode(text, disallowed_special=()))
+
+def embedding_batches(items, max_tokens, max_items, errors):
+    """Group (index, line) pairs into batches bounded by total tokens and item count.
+
+    Chunks over the backend's input limit are reported in errors instead of sent.
+    """
+    batch, batch_tokens = [], 0
+    for i, line in items:
+        tokens = count_tokens(line)
+        if tokens > backend.max_input_tokens:
+            errors.append((i, line, ValueError(f"chunk has {tokens} tokens, limit is {backend.max_input_tokens}")))
+            continue
+        if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append((i, line))
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+# Chunk ids are derived from (url, version, content hash), so re-loading an
+# unchanged chunk maps onto the row that already exists.
+CHUNK_NAMESPACE = uuid.UUID("8e5c7a1e-3f0b-4d61-9a56-1f2d3c4b5a69")
+
+def chunk_id(url, version, text):
+    content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return uuid.uuid5(CHUNK_NAMESPACE, f"{url}\n{version}\n{content_hash}")
+
+def existing_chunk_ids(conn, url, version):
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM embeddings WHERE url = %s AND version = %s", (url, version))
+        return {row[0] for row in cur.fetchall()}
+
+def mark_version_changed(cur, version):
+    """Bump the change marker of version, in the caller's transaction."""
+    cur.execute("UPSERT INTO embedding_versions (version, updated_at) VALUES (%s, now())", (version,))
+
+def delete_chunks(conn, ids, version, batch_size=1000):
+    ids = list(ids)
+    for i in range(0, len(ids), batch_size):
+        with conn.transaction():
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM embeddings WHERE id = ANY(%s)", (ids[i:i + batch_size],))
+                cur.execute("DELETE FROM chunk_duplicates WHERE canonical_id = ANY(%s)", (ids[i:i + batch_size],))
+                mark_version_changed(cur, version)
+
+def embed_texts(texts):
+    """Embed a list of texts with one backend call (one API request for OpenAI)."""
+    return backend.embed_sync(texts)
+
+COLUMNS = ["id", "version", "url", "text", "headings", "tokens", "simhash", "embedding", "embedding_compact"]
+
+def write_rows(conn, rows):
+    """Write rows with one multi-row UPSERT in an explicit transaction.
+
+    Rows carry embedding_compact as a ninth value when compact search is on.
+    """
+    columns = COLUMNS[:len(rows[0])]
+    values = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows))
+    params = [v for row in rows for v in row]
+    with conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute(
+                f"UPSERT INTO embeddings ({', '.join(columns)}) VALUES {values}",
+                params
+            )
+            logging.debug("write_rows(): status message: %s", cur.statusmessage)
+            for version in {row[1] for row in rows}:
+                mark_version_changed(cur, version)
+
+def stored_fingerprints(conn, version, page_size=5000):
+    """Yield (id, url, simhash, text) of the rows of version; text only where simhash is missing."""
+    last = uuid.UUID(int=0)
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, url, simhash, CASE WHEN simhash IS NULL THEN text END FROM embeddings "
+                        "WHERE version = %s AND id > %s ORDER BY id LIMIT %s", (version, last, page_size))
+            page = cur.fetchall()
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1][0]
+
+def near_duplicates(conn, pending, ids, url, version, wanted, max_distance=3, same_url=False):
+    """Split pending [(i, text)] into chunks to load and near-duplicates.
+
+    Each chunk is compared with the stored chunks of version (only those of
+    url with same_url) and with the chunks before it in this run. Returns
+    (kept, duplicates, fingerprints); duplicates are (i, canonical id,
+    distance, canonical is stored).
+    """
+    index = SimHashIndex(max_distance)
+    stored = set()
+    for id_, row_url, fingerprint, text in stored_fingerprints(conn, version):
+        if row_url == url and id_ not in wanted:
+            continue  # an old chunk of this url, may be deleted by this run
+        if same_url and row_url != url:
+            continue
+        fingerprint = from_signed(fingerprint) if fingerprint is not None else simhash(text)
+        if fingerprint is not None and fingerprint != NO_WORDS:
+            index.add(fingerprint, id_)
+            stored.add(id_)
+
+    kept, duplicates, fingerprints = [], [], {}
+    for i, line in pending:
+        fingerprints[i] = simhash(line)
+        if ids[i] in stored or fingerprints[i] is None:
+            # this very chunk is stored already (not --incremental) and is rewritten,
+            # or it has no words to compare
+            kept.append((i, line))
+            continue
+        match = index.nearest(fingerprints[i])
+        if match is None:
+            index.add(fingerprints[i], ids[i])
+            kept.append((i, line))
+        else:
+            duplicates.append((i, match[0], match[1], match[0] in stored))
+    return kept, duplicates, fingerprints
+
+def write_duplicate_links(conn, chunks, ids, duplicates, url, version):
+    """Replace the chunk_duplicates rows of (url, version) with duplicates."""
+    with conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM chunk_duplicates WHERE version = %s AND url = %s", (version, url))
+            for i in range(0, len(duplicates), 500):
+                batch = duplicates[i:i + 500]
+                values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(batch))
+                cur.execute("UPSERT INTO chunk_duplicates "
+                            "(id, version, url, headings, canonical_id, distance, text, tokens) "
+                            f"VALUES {values}",
+                            [v for j, canonical, distance, _ in batch
+                             for v in (ids[j], version, url, chunks[j].headings, canonical, distance,
+                                       chunks[j].text, count_prompt_tokens(chunks[j].text))])
+
+def linked_duplicates(conn, canonical_ids):
+    """(id, url, headings, text, tokens) of the chunks linked to any of canonical_ids."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, url, headings, text, tokens FROM chunk_duplicates "
+                    "WHERE canonical_id = ANY(%s)", (list(canonical_ids),))
+        return cur.fetchall()
+
+def insert_embeddings (conn, chunks, version, url, embed_batch_tokens=100000,
+                       embed_batch_size=512, insert_batch_size=100, concurrency=4,
+                       tokens_per_minute=None, incremental=False, projection=None,
+                       dedup=None, dedup_distance=3):
+    """Embed chunks in token-bounded batches and bulk insert them.
+
+    Embedding requests run concurrently (see pipeline.IngestPipeline), backing
+    off on rate limits and staying under tokens_per_minute; inserts are retried
+    on transaction conflicts. Returns the number of rows written; failed
+    chunks are logged individually.
+
+    With incremental=True, chunks already stored for (url, version) are
+    skipped without calling the embeddings API, and stored chunks that no
+    longer appear in chunks are deleted.
+
+    With a projection (see compact.py), embedding_compact is written as well.
+
+    With dedup="skip", chunks within dedup_distance bits (SimHash, see
+    dedup.py) of a stored chunk of url or of an earlier chunk of this run are
+    not embedded or written. dedup="link" compares with the stored chunks of
+    the whole version and records each one, text included, in
+    chunk_duplicates with the chunk it duplicates. A chunk only counts as a
+    duplicate once the chunk it duplicates is stored: duplicates of chunks of
+    this run that failed are loaded themselves, and chunks linked to a stale
+    chunk are loaded before it is deleted.
+    """
     conn.autocommit = True
+    errors = []
+    max_items = min(embed_batch_size, MAX_BATCH_INPUTS)
+
+    # Identical chunks share an id, so only the first copy is loaded
+    ids = {}
+    wanted = set()
+    pending = []
+    for i, chunk in enumerate(chunks):
+        ids[i] = chunk_id(url, version, chunk.text)
+        if ids[i] not in wanted:
+            wanted.add(ids[i])
+            pending.append((i, chunk.text))
+
+    stale = set()
+    if incremental:
+        existing = existing_chunk_ids(conn, url, version)
+        stale = existing - wanted
+        pending = [(i, line) for i, line in pending if ids[i] not in existing]
+        print(f"Incremental load: {len(wanted) - len(pending)} unchanged, "
+              f"{len(pending)} new or changed, {len(stale)} to delete")
+
+    fingerprints, duplicates = {}, []
+    if dedup:
+        before = pending
+        pending, duplicates, fingerprints = near_duplicates(conn, pending, ids, url, version, wanted,
+                                                            dedup_distance, same_url=dedup == "skip")
+        # What the duplicates would have cost: embedding batches, inputs and tokens
+        calls_saved = (sum(1 for _ in embedding_batches(before, embed_batch_tokens, max_items, []))
+                       - sum(1 for _ in embedding_batches(pending, embed_batch_tokens, max_items, [])))
+        of_stored = sum(1 for d in duplicates if d[3])
+        print(f"Near-duplicates ({dedup}): {len(duplicates)} of {len(before)} chunks, "
+              f"{of_stored} of stored chunks and {len(duplicates) - of_stored} within this run; "
+              f"saved {len(duplicates)} rows, {len(duplicates)} embedding inputs "
+              f"({sum(chunks[d[0]].tokens for d in duplicates)} tokens) and {calls_saved} embedding calls")
+
+    def to_row(i, line, embedding):
+        # Kept as float32; the registered VECTOR dumper serializes it
+        fingerprint = to_signed(fingerprints[i]) if fingerprints.get(i) is not None else None
+        row = (ids[i], version, url, line, chunks[i].headings, count_prompt_tokens(line), fingerprint,
+               to_vector(embedding))
+        if projection is not None:
+            row += (projection.project(embedding),)
+        return row
+
+    def ingest(items, make_row, desc):
+        """Embed and write items [(key, text)]; returns (stats, failed [(key, text, error)])."""
+        failed = []
+        with tqdm(total=len(items), desc=desc) as progress:
+            pipeline = IngestPipeline(embed_texts, make_row, lambda rows: write_rows(conn, rows),
+                                      count_tokens, concurrency=concurrency,
+                                      tokens_per_minute=tokens_per_minute,
+                                      insert_batch_size=insert_batch_size, progress=progress)
+            stats = pipeline.run(embedding_batches(items, embed_batch_tokens, max_items, failed))
+            progress.update(len(items) - progress.n)
+        return stats, failed + pipeline.errors
+
+    def add_stats(stats, more):
+        return {key: stats[key] + more[key] for key in stats}
+
+    stats, failed = ingest(pending, to_row, "Creating embeddings")
+    errors += failed
+
+    # Duplicates of a chunk of this run that failed to load are loaded themselves
+    failed_ids = {ids[err[0]] for err in errors}
+    orphans = [d for d in duplicates if not d[3] and d[1] in failed_ids]
+    if orphans:
+        duplicates = [d for d in duplicates if d[3] or d[1] not in failed_ids]
+        orphaned = [(d[0], chunks[d[0]].text) for d in orphans]
+        print(f"Loading {len(orphans)} near-duplicates of chunks that failed to load")
+        more, failed = ingest(orphaned, to_row, "Near-duplicates")
+        stats, pending = add_stats(stats, more), pending + orphaned
+        errors += failed
+    if dedup == "link":
+        write_duplicate_links(conn, chunks, ids, duplicates, url, version)
+
+    if stale:
+        if errors:
+            # Keep the old rows around until every replacement made it in
+            logging.warning("not deleting %d stale chunks because %d chunks failed", len(stale), len(errors))
+        else:
+            # Chunks of other urls left out as near-duplicates of a stale chunk
+            # are loaded before it goes
+            linked = linked_duplicates(conn, stale)
+            for row in linked:
+                if row[3] is None:
+                    logging.warning("near-duplicate %s was linked before chunk_duplicates kept text; "
+                                    "reload %s to restore it", row[0], row[1])
+            linked = [row for row in linked if row[3] is not None]
+            requeued = []
+            if linked:
+                def linked_row(j, line, embedding):
+                    id_, row_url, headings, _, tokens = linked[j]
+                    fingerprint = simhash(line)
+                    row = (id_, version, row_url, line, headings, tokens,
+                           to_signed(fingerprint) if fingerprint is not None else None, to_vector(embedding))
+                    if projection is not None:
+                        row += (projection.project(embedding),)
+                    return row
+                print(f"Loading {len(linked)} near-duplicates of chunks to delete")
+                relinked = [(j, row[3]) for j, row in enumerate(linked)]
+                more, requeued = ingest(relinked, linked_row, "Near-duplicates of deleted chunks")
+                stats, pending = add_stats(stats, more), pending + relinked
+            if requeued:
+                logging.warning("not deleting %d stale chunks because %d of their near-duplicates failed",
+                                len(stale), len(requeued))
+                for j, line, e in requeued:
+                    logging.error("failed to load near-duplicate %s: %s", linked[j][0], e)
+            else:
+                delete_chunks(conn, stale, version)
+                print(f"Deleted {len(stale)} chunks no longer in the source")
+    elapsed = stats["seconds"]
+    inserted = stats["written"]
+    for i, line, e in sorted(errors, key=lambda err: err[0]):
+        logging.error("failed to insert embedding for line %d: %s", i, line[0:20])
+        logging.error(e)
+    print(f"Inserted {inserted}/{len(pending)} chunks in {elapsed:.1f}s "
+          f"({inserted / elapsed if elapsed else 0:.1f} chunks/sec), {len(errors)} failed; "
+          f"{stats['api_calls']} embedding calls, {stats['rate_limited']} rate limited "
+          f"(in {stats['rate_limit_episodes']} episodes), "
+          f"{stats['db_retries']} transaction retries")
+    return inserted
+
+def stored_projection(conn, version):
+    """Stored projection of version, or None (also when compact search was never set up)."""
+    try:
+        with conn.transaction():
+            return load_projection(conn, version)
+    except psycopg.errors.UndefinedTable:
+        return None
+
+def compact_projection(conn, version, dimensions, method, refit=False):
+    """Stored projection of version for the compact column, or None if it has to be fit after loading."""
+    stored = None if refit else load_projection(conn, version)
+    if stored is not None:
+        if (stored.kind, stored.dimensions) != (method, dimensions):
+            raise ValueError(f"{version} is stored with a {stored.kind} projection to {stored.dimensions} "
+                             f"dimensions; pass --refit-compact to replace it")
+        return stored
+    if method == "truncate" and not refit:
+        projection = Projection("truncate", dimensions)
+        with conn.cursor() as cur:
+            store_projection(cur, version, projection)
+        return projection
+    # PCA is fit on the embeddings once they are loaded
+    return None
+
+def version_embeddings(conn, version, missing_only=False, page_size=1000):
+    """Yield pages of (id, embedding) rows of version, optionally only rows without embedding_compact."""
+    missing = " AND embedding_compact IS NULL" if missing_only else ""
+    last = uuid.UUID(int=0)
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT id, embedding FROM embeddings WHERE version = %s AND id > %s{missing} "
+                        "ORDER BY id LIMIT %s", (version, last, page_size))
+            page = cur.fetchall()
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last = page[-1][0]
+
+def recount_tokens(conn, version, page_size=1000):
+    """Rewrite the tokens column of version with count_prompt_tokens; returns the number of rows updated."""
+    updated = 0
+    last = uuid.UUID(int=0)
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, text FROM embeddings WHERE version = %s AND id > %s ORDER BY id LIMIT %s",
+                        (version, last, page_size))
+            page = cur.fetchall()
+        if page:
+            with conn.transaction():
+                with conn.cursor() as cur:
+                    cur.executemany("UPDATE embeddings SET tokens = %s WHERE id = %s",
+                                    [(count_prompt_tokens(row[1] or ""), row[0]) for row in page])
+            updated += len(page)
+        if len(page) < page_size:
+            return updated
+        last = page[-1][0]
+
+def backfill_compact(conn, version, projection, missing_only=True):
+    """Write embedding_compact for the rows of version; returns the number of rows updated."""
+    updated = 0
+    for page in version_embeddings(conn, version, missing_only):
+        with conn.transaction():
+            with conn.cursor() as cur:
+                cur.executemany("UPDATE embeddings SET embedding_compact = %s WHERE id = %s",
+                                [(projection.project(row[1]), row[0]) for row in page])
+        updated += len(page)
+    return updated
+
+def fit_compact(conn, version, dimensions, method):
+    """Fit and store the projection of version, then rewrite embedding_compact of all its rows."""
+    if method == "truncate":
+        projection = Projection("truncate", dimensions)
+    else:
+        vectors = [row[1] for page in version_embeddings(conn, version) for row in page]
+        try:
+            projection = fit_pca(vectors, dimensions)
+        except ValueError as e:
+            logging.warning("compact search stays off for %s: %s", version, e)
+            return None
     with conn.cursor() as cur:
-        for i, line in enumerate(tqdm(text_lines, desc="Creating embeddings")):
-            try:
-                id = uuid.uuid4()
-                logging.info("insert_embeddings(): %s", line[0:20])
-                # Insert the embedding
-                # embedding = normalize_vector(model.encode(line))
-                # embedding = response['data'][0]['embedding']
-    
-                # Call OpenAI Embeddings API
-                response = client.embeddings.create(
-                    input=[line],
-                    model="text-embedding-ada-002"  # This is the current recommended embedding model
-                )
-                embedding = response.data[0].embedding
-                
-                # Convert list to PostgreSQL-compatible format
-                embedding_str = f"[{','.join(map(str, embedding))}]"
-                cur.execute(
-                    "INSERT INTO embeddings (id, version, url, text, embedding) VALUES (%s, %s, %s, %s, %s)",
-                    (id, version, url, line, embedding_str)
-                )
-                # conn.commit()
-                logging.debug("insert_embeddings(): status message: %s",
-                            cur.statusmessage)
-            except Exception as e:
-                logging.error("failed to insert embedding for line %d: %s", i, line[0:20])
-                logging.error(e)   
-    return len(text_lines)
+        store_projection(cur, version, projection)
+    updated = backfill_compact(conn, version, projection, missing_only=False)
+    print(f"Fit {method} projection to {dimensions} dimensions for {version}, {updated} rows updated")
+    return projection
 
 def main():
     parser = argparse.ArgumentParser(description="Process markdown file for embeddings.")
     parser.add_argument("--mdfile", required=True, help="Path to the markdown file to process")
     parser.add_argument("--url", required=True, help="URL of the markdown file")
-    parser.add_argument("--delimiter", default="# ", help="Delimiter to split the markdown file (default: '# ')")
+    parser.add_argument("--chunk-tokens", type=int, default=512,
+                        help="Target chunk size in tokens, capped to the input limit of the embedding "
+                             "model, e.g. 256 for all-MiniLM-L6-v2 (default: 512)")
+    parser.add_argument("--chunk-overlap", type=int, default=64,
+                        help="Tokens of trailing context repeated in the next chunk (default: 64)")
     parser.add_argument("--version", default="v25.2", help="Version of cockroachdb (default: v25.2)")
+    parser.add_argument("--embed-batch-tokens", type=int, default=100000,
+                        help="Max total tokens per embeddings API call (default: 100000)")
+    parser.add_argument("--embed-batch-size", type=int, default=512,
+                        help="Max chunks per embeddings API call (default: 512)")
+    parser.add_argument("--insert-batch-size", type=int, default=100,
+                        help="Rows per multi-row INSERT transaction (default: 100)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Concurrent embeddings API requests (default: 4)")
+    parser.add_argument("--tokens-per-minute", type=int, default=None,
+                        help="Embedding token budget per minute, e.g. your OpenAI TPM limit (default: unlimited)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only embed new or changed chunks and delete chunks that disappeared from the source")
+    parser.add_argument("--dedup", choices=["skip", "link"], default=None,
+                        help="Leave out chunks that nearly duplicate an earlier chunk or a stored chunk of "
+                             "the url ('skip') or of the whole version ('link', recorded in chunk_duplicates) "
+                             "(default: off)")
+    parser.add_argument("--dedup-distance", type=int, default=3,
+                        help="Max SimHash bits (of 64) between near-duplicates (default: 3)")
+    parser.add_argument("--embedding-backend", choices=["openai", "local"],
+                        default=os.environ.get("EMBEDDING_BACKEND", "openai"),
+                        help="openai embeddings API or a local CPU model (default: $EMBEDDING_BACKEND or openai)")
+    parser.add_argument("--embedding-model", default=os.environ.get("EMBEDDING_MODEL"),
+                        help="Embedding model (default: text-embedding-ada-002 / all-MiniLM-L6-v2)")
+    parser.add_argument("--embedding-dimensions", type=int, default=None,
+                        help="Shortened output size for text-embedding-3 models")
+    parser.add_argument("--onnx-path", default=os.environ.get("LOCAL_EMBEDDING_ONNX_PATH"),
+                        help="Directory with model.onnx and tokenizer.json to run the local model with onnxruntime")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Inference threads of the local model (default: all cores)")
+    parser.add_argument("--compact-dimensions", type=int, default=None,
+                        help="Set up (or, with --refit-compact, refit) a reduced-dimension embedding_compact "
+                             "column for candidate search; later loads of the version keep writing it")
+    parser.add_argument("--compact-method", choices=["pca", "truncate"], default="pca",
+                        help="pca: fit on the version's embeddings; truncate: for text-embedding-3 models (default: pca)")
+    parser.add_argument("--refit-compact", action="store_true",
+                        help="Refit the projection of the version and rewrite all its compact vectors")
+    parser.add_argument("--recount-tokens", action="store_true",
+                        help="Recount the tokens column of every row of the version in the chat model's "
+                             "encoding (rows loaded before it were counted with cl100k_base)")
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.WARNING)
+    global backend
+    backend = create_backend(args.embedding_backend, model=args.embedding_model,
+                             dimensions=args.embedding_dimensions, client=client,
+                             onnx_path=args.onnx_path, threads=args.threads)
+    if args.chunk_tokens > backend.max_input_tokens:
+        # A local model stops reading at its max_seq_length; longer chunks would
+        # be embedded from their first part only
+        logging.warning("--chunk-tokens %d is over the %d token input limit of %s, using %d",
+                        args.chunk_tokens, backend.max_input_tokens, backend.name, backend.max_input_tokens)
+        args.chunk_tokens = backend.max_input_tokens
     try:
         # Attempt to connect to cluster with connection string provided to
         # script. By default, this script uses the value saved to the
@@ -125,9 +600,38 @@ def main():
         conn = psycopg.connect(db_url,
                             application_name="create_embeddings", 
                             row_factory=namedtuple_row)
-        create_schema(conn)
-        text_lines = chunking(args.mdfile, args.delimiter)
-        insert_embeddings(conn, text_lines, args.version, args.url)
+        create_schema(conn, backend.dimensions, args.compact_dimensions)
+        vector_info = fetch_vector_info(conn)
+        if vector_info is not None:
+            probe_binary(conn, vector_info)
+        else:
+            register_vector(conn)
+        if args.compact_dimensions:
+            projection = compact_projection(conn, args.version, args.compact_dimensions,
+                                            args.compact_method, args.refit_compact)
+        else:
+            # The API searches a version with a stored projection on embedding_compact,
+            # so its new rows need one even without --compact-dimensions
+            projection = stored_projection(conn, args.version)
+        chunks = chunking(args.mdfile, args.chunk_tokens, args.chunk_overlap)
+        insert_embeddings(conn, chunks, args.version, args.url,
+                          embed_batch_tokens=args.embed_batch_tokens,
+                          embed_batch_size=args.embed_batch_size,
+                          insert_batch_size=args.insert_batch_size,
+                          concurrency=args.concurrency,
+                          tokens_per_minute=args.tokens_per_minute,
+                          incremental=args.incremental,
+                          dedup=args.dedup, dedup_distance=args.dedup_distance,
+                          projection=projection)
+        if args.compact_dimensions and projection is None:
+            fit_compact(conn, args.version, args.compact_dimensions, args.compact_method)
+        elif projection is not None:
+            # rows loaded before compact search was turned on, or by an older loader
+            updated = backfill_compact(conn, args.version, projection)
+            if updated:
+                print(f"Wrote embedding_compact for {updated} existing rows")
+        if args.recount_tokens:
+            print(f"Recounted tokens of {recount_tokens(conn, args.version)} rows of {args.version}")
     except Exception as e:
         logging.fatal("database connection failed")
         logging.fatal(e)   
@@ -0,0 +1,85 @@
+# coding: utf-8
+"""Near-duplicate detection for chunks with 64-bit SimHash.
+
+A chunk's fingerprint is the SimHash of its word 3-shingles (lowercased,
+punctuation dropped), so chunks that share most of their text differ in
+only a few bits. Two chunks are near-duplicates when their fingerprints
+are within `max_distance` bits (Hamming distance). Text without any word
+(code or tables of symbols only, separator lines) has no fingerprint and
+is never a near-duplicate.
+
+SimHashIndex finds them without comparing every pair: the 64 bits are cut
+into max_distance + 1 bands, and by the pigeonhole principle two
+fingerprints within max_distance bits agree exactly on at least one band,
+so only fingerprints sharing a band value are compared.
+"""
+import hashlib
+import re
+
+import numpy as np
+
+WORD = re.compile(r"\w+")
+MASK = (1 << 64) - 1
+_BITS = np.arange(64, dtype=np.uint64)
+
+
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# What older loads stored as the fingerprint of text without words
+NO_WORDS = _feature_hash("")
+
+
+def simhash(text, shingle=3):
+    """Unsigned 64-bit SimHash of text, or None if text has no words."""
+    words = WORD.findall(text.lower())
+    if not words:
+        return None
+    if len(words) <= shingle:
+        features = [" ".join(words)]
+    else:
+        features = [" ".join(words[i:i + shingle]) for i in range(len(words) - shingle + 1)]
+    hashes = np.array([_feature_hash(f) for f in features], dtype=np.uint64)
+    ones = ((hashes[:, None] >> _BITS) & np.uint64(1)).sum(axis=0)
+    bits = ones * 2 > len(hashes)
+    return int((bits.astype(np.uint64) << _BITS).sum())
+
+
+def to_signed(value):
+    """Unsigned 64-bit fingerprint as stored in an INT8 column."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def from_signed(value):
+    return value & MASK
+
+
+class SimHashIndex:
+
+    def __init__(self, max_distance=3):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        widths = [64 // bands + (1 if i < 64 % bands else 0) for i in range(bands)]
+        starts = np.cumsum([0] + widths[:-1])
+        self.bands = [(int(start), (1 << width) - 1) for start, width in zip(starts, widths)]
+        self.buckets = {}
+        self.size = 0
+
+    def _keys(self, fingerprint):
+        return [(i, (fingerprint >> start) & mask) for i, (start, mask) in enumerate(self.bands)]
+
+    def add(self, fingerprint, key):
+        for band in self._keys(fingerprint):
+            self.buckets.setdefault(band, []).append((fingerprint, key))
+        self.size += 1
+
+    def nearest(self, fingerprint):
+        """(key, distance) of the closest indexed fingerprint within max_distance, or None."""
+        best = None
+        for band in self._keys(fingerprint):
+            for other, key in self.buckets.get(band, ()):
+                distance = bin(fingerprint ^ other).count("1")
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (key, distance)
+        return best
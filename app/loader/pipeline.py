@@ -0,0 +1,314 @@
+# coding: utf-8
+"""Concurrent ingestion pipeline for the loader.
+
+Three stages connected by bounded queues:
+
+    reader  -> [embed queue] -> N embedders -> [write queue] -> writer
+
+The reader iterates batches of (key, text) pairs, embedders call the
+embeddings API with adaptive concurrency and a tokens-per-minute budget, and
+the writer stores rows in the database, retrying transaction conflicts.
+"""
+import logging
+import queue
+import random
+import re
+import threading
+import time
+
+import openai
+
+_DONE = object()
+
+
+class TokenBudget:
+    """Token bucket enforcing a tokens-per-minute limit across threads."""
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n):
+        # A request larger than the whole budget waits for a full bucket
+        n = min(n, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that halves on rate limiting and grows back on success (AIMD).
+
+    A 429 also pauses every worker until the server's Retry-After (or an
+    exponential backoff) has passed. A burst of 429s is one congestion
+    episode: acquire() returns the episode a request was sent in, and 429s of
+    requests sent before the current episode began neither halve the limit
+    again nor extend the pause.
+    """
+
+    def __init__(self, max_concurrency, max_backoff=60.0):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        self.resume_at = 0.0
+        self.episode = 0
+        self.episodes = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a slot; returns the current episode, to be passed to release()."""
+        with self.cond:
+            while True:
+                pause = self.resume_at - time.monotonic()
+                if pause > 0:
+                    self.cond.wait(pause)
+                elif self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return self.episode
+                else:
+                    self.cond.wait()
+
+    def release(self, episode, rate_limited=False, retry_after=None):
+        with self.cond:
+            self.in_flight -= 1
+            if rate_limited and episode == self.episode:
+                self.episode += 1
+                self.episodes += 1
+                self.limit = max(1.0, self.limit / 2)
+                self.backoff = min(self.max_backoff, max(1.0, self.backoff * 2))
+                delay = retry_after if retry_after is not None else self.backoff
+                self.resume_at = max(self.resume_at, time.monotonic() + delay * random.uniform(1.0, 1.2))
+            elif not rate_limited:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / max(self.limit, 1.0))
+                self.backoff = 0.0
+            self.cond.notify_all()
+
+
+def parse_duration(value):
+    """Seconds of an x-ratelimit-reset-* value such as "1s", "6m0s" or "20ms"."""
+    match = re.fullmatch(r"(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?"
+                         r"(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?", value.strip())
+    if not match or not any(match.groups()):
+        return None
+    hours, minutes, seconds, millis = (float(g or 0) for g in match.groups())
+    return hours * 3600 + minutes * 60 + seconds + millis / 1000
+
+
+def retry_after_seconds(error):
+    """Seconds to wait after a rate limit error: Retry-After if the server sent
+    one, else the reset time of whichever x-ratelimit-remaining-* is exhausted."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    resets = []
+    for kind in ("requests", "tokens"):
+        if headers.get(f"x-ratelimit-remaining-{kind}") == "0" and headers.get(f"x-ratelimit-reset-{kind}"):
+            resets.append(parse_duration(headers[f"x-ratelimit-reset-{kind}"]))
+    resets = [r for r in resets if r is not None]
+    return max(resets) if resets else None
+
+
+def is_quota_error(error):
+    """insufficient_quota comes as a RateLimitError but no retry will succeed."""
+    return getattr(error, "code", None) == "insufficient_quota"
+
+
+def is_input_error(error):
+    """A 4xx caused by the request's inputs (e.g. a text over the model's limit)."""
+    return isinstance(error, (openai.BadRequestError, openai.UnprocessableEntityError))
+
+
+def is_transient_api_error(error):
+    return isinstance(error, (openai.APIConnectionError, openai.APITimeoutError,
+                              openai.InternalServerError))
+
+
+def is_retryable_db_error(error):
+    # 40001: CockroachDB transaction retry error
+    return getattr(error, "sqlstate", None) == "40001"
+
+
+class IngestPipeline:
+    """Runs reader, embedding and writer stages concurrently.
+
+    embed(texts) returns one embedding per text; to_row(key, text, embedding)
+    builds a row; write(rows) stores a list of rows in one transaction;
+    count_tokens(text) sizes requests against the token budget.
+    """
+
+    def __init__(self, embed, to_row, write, count_tokens, concurrency=4,
+                 tokens_per_minute=None, queue_size=8, insert_batch_size=100,
+                 max_retries=8, progress=None):
+        self.embed = embed
+        self.to_row = to_row
+        self.write = write
+        self.count_tokens = count_tokens
+        self.concurrency = concurrency
+        self.limiter = AdaptiveLimiter(concurrency)
+        self.budget = TokenBudget(tokens_per_minute) if tokens_per_minute else None
+        self.embed_queue = queue.Queue(maxsize=queue_size)
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.insert_batch_size = insert_batch_size
+        self.max_retries = max_retries
+        self.progress = progress
+        self.errors = []
+        self.reader_error = None
+        self.stats = {"chunks": 0, "embedded": 0, "written": 0, "api_calls": 0,
+                      "rate_limited": 0, "api_retries": 0, "db_retries": 0}
+        self.lock = threading.Lock()
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def _read(self, batches):
+        try:
+            for batch in batches:
+                self._count("chunks", len(batch))
+                self.embed_queue.put(batch)
+        except Exception as e:
+            self.reader_error = e
+        finally:
+            for _ in range(self.concurrency):
+                self.embed_queue.put(_DONE)
+
+    def _embed_with_retry(self, batch):
+        texts = [text for _, text in batch]
+        tokens = sum(self.count_tokens(text) for text in texts)
+        attempt = 0
+        while True:
+            if self.budget is not None:
+                self.budget.acquire(tokens)
+            episode = self.limiter.acquire()
+            self._count("api_calls")
+            try:
+                embeddings = self.embed(texts)
+            except openai.RateLimitError as e:
+                if is_quota_error(e):
+                    self.limiter.release(episode)
+                    raise
+                self.limiter.release(episode, rate_limited=True, retry_after=retry_after_seconds(e))
+                self._count("rate_limited")
+                error = e
+            except Exception as e:
+                self.limiter.release(episode)
+                if not is_transient_api_error(e):
+                    raise
+                error = e
+                time.sleep(min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0))
+            else:
+                self.limiter.release(episode)
+                return embeddings
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+            self._count("api_retries")
+            logging.info("embedding batch of %d retrying (%d): %s", len(batch), attempt, error)
+
+    def _embed_batch(self, batch):
+        """Embed a batch; a batch rejected for its inputs is split so each bad chunk
+        is reported on its own. Rate limit, quota and transient failures that
+        outlast the retries fail the whole batch."""
+        try:
+            embeddings = self._embed_with_retry(batch)
+        except Exception as e:
+            if not is_input_error(e):
+                raise
+            if len(batch) == 1:
+                self.errors.append((batch[0][0], batch[0][1], e))
+                return []
+            logging.warning("batch of %d chunks failed (%s), retrying one by one", len(batch), e)
+            return [row for item in batch for row in self._embed_batch([item])]
+        self._count("embedded", len(batch))
+        return [(key, text, self.to_row(key, text, embedding))
+                for (key, text), embedding in zip(batch, embeddings)]
+
+    def _embedder(self):
+        while True:
+            batch = self.embed_queue.get()
+            if batch is _DONE:
+                self.write_queue.put(_DONE)
+                return
+            try:
+                rows = self._embed_batch(batch)
+            except Exception as e:
+                rows = []
+                self.errors.extend((key, text, e) for key, text in batch)
+            self.write_queue.put((batch, rows))
+
+    def _write_with_retry(self, rows):
+        attempt = 0
+        while True:
+            try:
+                self.write([row for _, _, row in rows])
+                return
+            except Exception as e:
+                if not is_retryable_db_error(e) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self._count("db_retries")
+                time.sleep(min(5.0, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    def _write_rows(self, rows):
+        try:
+            self._write_with_retry(rows)
+            self._count("written", len(rows))
+        except Exception as e:
+            if len(rows) == 1:
+                self.errors.append((rows[0][0], rows[0][1], e))
+                return
+            logging.warning("insert of %d rows failed (%s), retrying one by one", len(rows), e)
+            for row in rows:
+                self._write_rows([row])
+
+    def _writer(self):
+        remaining = self.concurrency
+        pending = []
+        while remaining:
+            item = self.write_queue.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            batch, rows = item
+            pending.extend(rows)
+            while len(pending) >= self.insert_batch_size:
+                self._write_rows(pending[:self.insert_batch_size])
+                pending = pending[self.insert_batch_size:]
+            if self.progress is not None:
+                self.progress.update(len(batch))
+        if pending:
+            self._write_rows(pending)
+
+    def run(self, batches):
+        """Ingest every batch; returns the stats dict. Failed chunks are in self.errors."""
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._read, args=(batches,), name="reader", daemon=True)]
+        threads += [threading.Thread(target=self._embedder, name=f"embedder-{i}", daemon=True)
+                    for i in range(self.concurrency)]
+        writer = threading.Thread(target=self._writer, name="writer", daemon=True)
+        for t in threads + [writer]:
+            t.start()
+        for t in threads + [writer]:
+            t.join()
+        self.stats["seconds"] = time.perf_counter() - start
+        self.stats["rate_limit_episodes"] = self.limiter.episodes
+        if self.reader_error is not None:
+            raise self.reader_error
+        return self.stats